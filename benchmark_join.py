@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks StreetsBikeJoin.join against the original per-street iterrows matcher
+and checks that both produce the same (segment, route) rows.
+
+Usage: benchmark_join.py <streets_preprocess output> <bike_routes_preprocess output>
+(eg the cached stage files in the pipeline cache directory)
+"""
+
+import sys
+import time
+
+import geopandas as gpd
+import pandas as pd
+
+from map_processor import BikeStreetsWrapper, StreetsBikeJoin
+from pipeline_interface import PipelineResult
+
+
+def reference_merge_street(streets, bike_routes, street_name):
+    street = streets.get_street(street_name)
+    bike_route = bike_routes.get_street(street_name)
+    cumulative = gpd.GeoDataFrame()
+    matched_segs = set([])
+    for ri, route in bike_route.iterrows():
+        matching = []
+        rgbuffer = route.geometry.buffer(3)
+        for si, seg in street.iterrows():
+            if rgbuffer.contains(seg.geometry):
+                matching.append(seg)
+                matched_segs.add(seg.trans_id)
+        matched_frame = gpd.GeoDataFrame(matching)
+        route_frame = pd.DataFrame([route.drop('geometry')])
+        if matched_frame.empty or route_frame.empty:
+            continue
+        m = matched_frame.merge(route_frame, left_on='street_nam', right_on='st_name')
+        cumulative = pd.concat([cumulative, m])
+    rest_streets = street[~street.trans_id.isin(matched_segs)]
+    return pd.concat([cumulative, rest_streets])
+
+
+def reference_join(streets, bike_routes):
+    bike_streets = streets.get_streets() & bike_routes.get_streets()
+    other_streets = streets.get_streets() - bike_routes.get_streets()
+    output = pd.concat([reference_merge_street(streets, bike_routes, s) for s in bike_streets])
+    ostr = streets.layer
+    return pd.concat([output, ostr[ostr.street_nam.isin(other_streets)]])
+
+
+def row_keys(df):
+    cols = ['trans_id', 'displayrou', 'st_name']
+    return df[cols].astype(str).value_counts().sort_index()
+
+
+if __name__ == "__main__":
+    # cached stage files are GeoParquet without an extension
+    streets = BikeStreetsWrapper(PipelineResult.from_cached(sys.argv[1], 'geopandas.GeoDataFrame').get())
+    bike_routes = BikeStreetsWrapper(PipelineResult.from_cached(sys.argv[2], 'geopandas.GeoDataFrame').get())
+    t0 = time.perf_counter()
+    reference = reference_join(streets, bike_routes)
+    t1 = time.perf_counter()
+    joined = StreetsBikeJoin.join(streets.layer, bike_routes.layer)
+    t2 = time.perf_counter()
+    print(f'reference: {len(reference)} rows in {t1 - t0:.2f}s')
+    print(f'vectorized: {len(joined)} rows in {t2 - t1:.2f}s')
+    same = row_keys(reference).equals(row_keys(joined))
+    print(f'equivalent: {same}')
+    sys.exit(0 if same else 1)
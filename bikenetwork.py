@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
 import os
 import itertools
 from dataclasses import dataclass
 
 import geopandas as gpd
-import shapely
+import numpy as np
+import pandas as pd
 import tqdm
 
+import columnar
+import geoutils
 import graphexplore
-from pipeline_interface import PipelineInterface, PipelineResult
+import routing
+from map_processor import SuitabilityRules
+from pipeline_interface import PipelineInterface, PipelineResult, plain_dtypes
 from constants import datasets_path, shapefile_path
 
 """
@@ -32,54 +38,144 @@ class Network:
     BUSINESS_POINTS = PointInfo(datasets_path() / 'chicago' / 'Business Licenses - Current Active - Map.geojson',
                                 'license_id')
 
-    def __init__(self, finder: graphexplore.NxFinder2, point_index: str):
+    def __init__(self, finder: graphexplore.NxFinder2, point_index: str, workers=1, aggregate=False, profiles=None,
+                 seed=0, convergence=None):
+        """
+        :param aggregate: Route once per pair of snapped nodes, weighting counts by the points on each node
+        :param profiles: Named suitability multipliers, overriding single entries of the configured ones;
+                         each adds a routegradient_<name> column
+        :param seed: Seed of the origin sample order in convergence mode
+        :param convergence: If set, origins are sampled in batches until the route gradient is precise enough,
+                            see routing.OriginSampler.run for the keys (batch, target_error, confidence,
+                            min_origins, max_origins); adds routegradient_ci columns. Off by default, since
+                            the counts are then estimates; sampled origins are always routed per snapped node,
+                            whatever aggregate is set to
+        """
         self.finder = finder
         self.point_index = point_index
+        self.workers = workers
+        self.aggregate = aggregate
+        self.profiles = profiles or {}
+        self.seed = seed
+        self.convergence = convergence
+        self.nodes = None
+        self.diagnostics = {}
+        self.errors = None
 
     def filter_points(self):
         # approx heuristic
         f = self.finder
-        return f.points_df.clip(shapely.geometry.box(*list(f.gdf.total_bounds)))
+        return geoutils.BoundaryClipper.for_boundaries(f.gdf_alt, mode='bounds').clip(f.points_alt)
 
-    def calculate_n2_network(self, limit=None):
+    def od_nodes(self) -> np.ndarray:
+        """
+        :return: Snapped base graph node of each filtered point, -1 if it did not snap; shared by all profiles
+        """
+        if self.nodes is None:
+            cf = self.filter_points()
+            nodes = self.finder.point_nodes(self.point_index).reindex(cf[self.point_index].to_numpy()).fillna(-1)
+            self.nodes = nodes.to_numpy(dtype=np.int64)
+        return self.nodes
+
+    def set_diagnostics(self, graph, weights, pairs, skipped, failed, **extra):
+        nodes = self.od_nodes()
+        self.diagnostics = {
+            **self.finder.diagnostics(graph, weights),
+            'filtered_points': len(nodes),
+            'unsnapped_filtered_points': int(np.count_nonzero(nodes < 0)),
+            'pairs': pairs,
+            'pairs_between_components': skipped,
+            'pairs_without_path': failed,
+            **extra,
+        }
+        print(f'Routing diagnostics: {self.diagnostics}')
+
+    def calculate_n2_network(self, limit=None, graph=None, weights=None, profile=None):
         """
         Run through all point pairs (bidirectionally) and store segment counts
-        :return: Segment counts
+        :param limit: Only route the first limit pairs; not with aggregate
+        :param graph: Routing graph of a weight profile, default the finder's graph
+        :param weights: Edge weights of that profile
+        :param profile: Suitability multipliers of that profile
+        :return: Segment counts, number of pairs, max route number per segment, both indexed by trans_id
+        """
+        graph = graph or self.finder.graph
+        if self.convergence:
+            return self.sample_network(graph, weights, profile)
+        nodes = self.od_nodes()
+        if self.aggregate:
+            if limit:
+                # a limit would count pairs of nodes, not of points, so the route gradient would be off
+                raise ValueError('limit is not supported with aggregate')
+            # one origin/destination per snapped node, weighted by the number of points on it;
+            # pairs of points on the same node have empty routes but still count towards iters
+            unique, multiplicity = np.unique(nodes[nodes >= 0], return_counts=True)
+            print(f'Aggregated {len(nodes)} points to {len(unique)} nodes')
+            counts, maxpos, failed, skipped, _ = routing.accumulate_od(
+                graph, graph.routing_nodes(unique), limit, self.workers, multiplicity=multiplicity)
+            iters = len(nodes) * (len(nodes) - 1)
+        else:
+            counts, maxpos, failed, skipped, iters = routing.accumulate_od(
+                graph, graph.routing_nodes(nodes), limit, self.workers)
+        self.set_diagnostics(graph, weights, iters, skipped, failed)
+        # a trans_id can appear on more than one row; rows of one trans_id share its totals
+        trans_id = pd.Series(graph.trans_id)
+        segcounts = pd.Series(counts).groupby(trans_id).sum()
+        routes = pd.Series(maxpos).groupby(trans_id).max()
+        used = segcounts > 0
+        return segcounts[used], iters, routes[used]
+
+    def sample_network(self, graph, weights=None, profile=None):
         """
-        segcounts = {}
-        routes = {}
-        iters = 0
-        cf = self.filter_points()
-        cross = cf.merge(cf[self.point_index], how='cross')
-        inputs = []
-        for _, row in cross.iterrows():
-            rx = row[f'{self.point_index}_x']
-            ry = row[f'{self.point_index}_y']
-            if rx == ry:
-                continue
-            iters += 1
-            if limit and iters > limit:
-                break
-            inputs.append((rx, ry))
-        paths = self.finder.route_edges(self.point_index, inputs)
-        for path, rt in paths:
-            #print(f'debug path: {path} {rt}')
-            for p in path:
-                segcounts[p] = segcounts.get(p, 0) + 1
-                routes[p] = max(routes.get(p, -1), rt)
-        return segcounts, iters, routes
+        Like calculate_n2_network, but counts only the routes from a seeded sample of origins, which grows
+        until the confidence intervals are narrow enough; the number of pairs is that of the sampled origins.
+        Sets self.errors to the confidence interval half width of the route gradient per trans_id.
+        The sample is saved with the compiled graph key, so a rerun with other limits extends it.
+        """
+        nodes = self.od_nodes()
+        params = self.convergence
+        confidence = params.get('confidence', 0.95)
+        groups, trans_ids = pd.factorize(pd.Series(graph.trans_id))
+        key = None
+        if self.finder.graph_key:
+            key = routing.GraphStore.key(self.finder.graph_key, self.seed, profile,
+                                         hashlib.sha256(nodes.tobytes()).hexdigest())
+        sampler = routing.OriginSampler(graph, graph.routing_nodes(nodes), groups, self.seed, key)
+        converged = sampler.run(params.get('batch', 64), params.get('target_error', 0.05), confidence,
+                                params.get('min_origins'), params.get('max_origins'), self.workers)
+        _, halfwidth = sampler.estimate(confidence)
+        self.errors = pd.Series(halfwidth, index=trans_ids)
+        self.set_diagnostics(graph, weights, sampler.pairs, sampler.skipped, sampler.failed,
+                             sampled_origins=sampler.sampled, converged=converged,
+                             error=sampler.error(confidence))
+        segcounts = pd.Series(sampler.sums, index=trans_ids)
+        routes = pd.Series(sampler.maxpos).groupby(pd.Series(graph.trans_id)).max()
+        used = segcounts > 0
+        return segcounts[used], sampler.pairs, routes[used]
 
     def apply(self):
         segcounts, iters, routes = self.calculate_n2_network()
-        with open('/tmp/raw_segcounts.json', 'w') as fh:
-            json.dump({'segcounts': segcounts, 'iters': iters}, fh)
+        raw = {'segcounts': {k: int(v) for k, v in segcounts.items()}, 'iters': iters,
+               'diagnostics': self.diagnostics, 'profiles': {}}
         new_df = self.finder.gdf.copy()
-        def apply_fn(x):
-            count = segcounts.get(x.trans_id, 0)
-            return count * 1.0 / iters
-        new_df['routegradient'] = new_df.apply(apply_fn, axis=1)
-        new_df['routesamp'] = new_df.apply(lambda x: routes.get(x.trans_id, -1), axis=1)
-        new_df['rtraw'] = new_df.apply(lambda x: segcounts.get(x.trans_id, -1), axis=1)
+        new_df['routegradient'] = new_df.trans_id.map(segcounts).fillna(0) / iters
+        new_df['routesamp'] = new_df.trans_id.map(routes).fillna(-1).astype(int)
+        new_df['rtraw'] = new_df.trans_id.map(segcounts).fillna(-1).astype(int)
+        if self.errors is not None:
+            new_df['routegradient_ci'] = new_df.trans_id.map(self.errors).fillna(0)
+        # same topology, snapped points and pairs; only the weights differ
+        for name, multipliers in self.profiles.items():
+            print(f'Routing weight profile {name}')
+            weights = self.finder.edge_weights(multipliers)
+            segcounts, iters, _ = self.calculate_n2_network(graph=self.finder.weighted_graph(weights), weights=weights,
+                                                            profile=multipliers)
+            new_df[f'routegradient_{name}'] = new_df.trans_id.map(segcounts).fillna(0) / iters
+            if self.errors is not None:
+                new_df[f'routegradient_{name}_ci'] = new_df.trans_id.map(self.errors).fillna(0)
+            raw['profiles'][name] = {'segcounts': {k: int(v) for k, v in segcounts.items()},
+                                     'diagnostics': self.diagnostics}
+        with open('/tmp/raw_segcounts.json', 'w') as fh:
+            json.dump(raw, fh)
         df2 = new_df.drop(columns=[x for x in new_df.columns if new_df[x].dtype.name.startswith('datetime')])
         return df2
 
@@ -89,10 +185,22 @@ class NetworkStage(PipelineInterface):
     def run_stage(self) -> PipelineResult:
         rv = PipelineResult()
         business_points = self.get_dependency('business_preprocess').get()
-        area = self.get_dependency('community_area_filter').get()
-        sample = self.stage_info['parameters']['sample_size']
-        nxfinder = graphexplore.NxFinder2(area, business_points, silent=False, sample=sample)
-        network = Network(nxfinder, self.stage_info['parameters']['points_key'])
+        area_result = self.get_dependency('community_area_filter')
+        area = area_result.get()
+        params = self.stage_info['parameters']
+        # the network file determines the graph, including the weights computed from the suitability rules
+        area_file = area_result.get_filename()
+        graph_key = None
+        if area_file:
+            graph_key = routing.GraphStore.key(columnar.content_hash(area_file), graphexplore.NxFinder2.MAX)
+        # profile weights use the rules the network weights were computed with
+        rules = SuitabilityRules(self.stage_parameters('bikestreets_off_join').get('suitability_rules'))
+        nxfinder = graphexplore.NxFinder2(area, business_points, silent=False, sample=params['sample_size'],
+                                          graph_key=graph_key, unreachable=params.get('unreachable', 'skip'),
+                                          contract=params.get('contract', True), seed=params.get('seed'),
+                                          rules=rules)
+        network = Network(nxfinder, params['points_key'], params.get('workers', 1), params.get('aggregate', False),
+                          params.get('profiles'), params.get('seed', 0), params.get('convergence'))
         applied = network.apply()
         filt = applied[applied.geometry.type == 'LineString']
         rv.obj = filt
@@ -102,17 +210,17 @@ class NetworkStage(PipelineInterface):
 class BusinessPreprocess(PipelineInterface):
     def run_stage(self) -> PipelineResult:
         rv = PipelineResult()
-        business = self.get_dependency('business_fetch').get()
         area = self.get_dependency('community_area_filter').get()
-        business.clip(shapely.geometry.box(*list(area.total_bounds)))
-        rv.obj = business
+        business = geoutils.to_crs(self.get_dependency('business_fetch').get(), area.crs)
+        rv.obj = geoutils.BoundaryClipper.for_boundaries(area, mode='bounds').clip(business)
         return rv
 
 
 class ShapefileOutput(PipelineInterface):
     def run_stage(self) -> PipelineResult:
         rv = PipelineResult()
-        netfile = self.get_dependency('network_analyze').get()
+        # layers stay in the working CRS through the pipeline; output in lon/lat
+        netfile = geoutils.to_crs(self.get_dependency('network_analyze').get(), 4326)
         rv.obj = netfile
-        netfile.to_file(shapefile_path() / 'computed_bike_network.shp')
+        plain_dtypes(netfile).to_file(shapefile_path() / 'computed_bike_network.shp')
         return rv
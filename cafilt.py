@@ -8,6 +8,7 @@ import geopandas
 import geopandas as gpd
 import shapely
 
+import geoutils
 from pipeline_interface import PipelineInterface, PipelineResult
 
 
@@ -20,10 +21,12 @@ class BoundaryFilter(PipelineInterface):
         params: dict = self.stage_info['parameters']
         boundary_field = params['field']
         values = params['values']
-        n = boundaries[boundaries[boundary_field].isin(values)]
-        if n.empty:
+        if not boundaries[boundary_field].isin(values).any():
             print(f'No boundary in {values} found')
             rv.obj = gpd.GeoDataFrame()
         else:
-            rv.obj = gdf.clip(n.envelope)
+            # mode: polygon, envelope (default) or bounds
+            clipper = geoutils.BoundaryClipper.for_boundaries(
+                boundaries, boundary_field, values, params.get('clip_mode', 'envelope'), gdf.crs)
+            rv.obj = clipper.clip(gdf)
         return rv
@@ -14,7 +14,6 @@ Improvements
   - filter Cook Co data to Chicago townships
 - better parsing of success status
     eg status: pending
-- fix pseudo-geojson (thegeometry column)
 - infer data series over time, use metadata to coalesce same set
 - read column metadata and make accessible
 
@@ -22,25 +21,25 @@ Improvements
 - https://data.cityofchicago.org/download/d5bx-dr8z/application%2Fx-zip-compressed
 """
 import argparse
-import io
 import json
 import os
 import urllib.parse
 import sys
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
 from typing import Callable
 from ast import literal_eval
-import geopandas
 
 import sanitize_filename
 from enum import Enum
 
 import pandas as pd
-import requests
 from peewee import SqliteDatabase, Model, CharField, IntegerField, DateTimeField, BooleanField, TextField, ForeignKeyField, DatabaseProxy
 
+import columnar
+import transport
 from interfaces import ManagerInterface
 from pipeline_interface import PipelineInterface, PipelineResult
 from constants import datasets_path
@@ -97,7 +96,7 @@ class GenericFetcher:
         self.raw = None
 
     def fetch(self):
-        r = requests.get(self.api_endpoint)
+        r = transport.get(self.api_endpoint)
         self.raw = r
         if r.status_code != 200:
             print(f'Received status {r.status_code} for {self.api_endpoint}')
@@ -252,6 +251,21 @@ class ManagerBase(ManagerInterface):
         dataset.save()
         return True
 
+    @staticmethod
+    def columnar_resource(dataset: DataSet):
+        """
+        Produces the normalized sidecar for a downloaded dataset, keyed by its content hash.
+
+        :return: Path of the GeoParquet sidecar
+        """
+        sha256 = dataset.sha256
+        if not sha256 or not columnar.sidecar_path(dataset.fullpath, sha256).exists():
+            sha256 = columnar.content_hash(dataset.fullpath)
+        if sha256 != dataset.sha256:
+            dataset.sha256 = sha256
+            dataset.save()
+        return columnar.ensure_sidecar(dataset.fullpath, sha256)
+
     def db_initialize(self):
         dbpath = os.path.join(self.catalog.destination_dir, 'fetchermetadata2.sqlite3')
         db = SqliteDatabase(dbpath)
@@ -307,6 +321,7 @@ class Manager(ManagerBase):
                 ext = 'zip'
         filename = sanitize_filename.sanitize(f'{dataset.name}.{ext}')
         fullpath = os.path.join(self.catalog.destination_dir, filename)
+        dataset.fullpath = fullpath
         if os.path.exists(fullpath):
             print(f'Skipping fetch because {fullpath} exists')
             print(f'Retrieved: {dataset.retrieved}')
@@ -314,11 +329,8 @@ class Manager(ManagerBase):
             print(f'Updated: {dataset.updated}')
             print(f'Data updated: {dataset.data_updated}')
             print(f'Metadata updated: {dataset.metadata_updated}')
-            if ext == 'zip':
-                return open(fullpath, 'rb').read(), dataset
-            return open(fullpath).read(), dataset
+            return self.columnar_resource(dataset), dataset
         dataset.retrieved = fetch_time
-        dataset.fullpath = fullpath
         # heuristic: mistrust updated too close to retrieved time?
         print(f'Fetching {filename}')
         # datasets available in csv or json
@@ -329,7 +341,7 @@ class Manager(ManagerBase):
         else:
             url = f'https://{self.catalog.domain}/resource/{id_}.json?$limit={self.limit}'
         print(f'Fetching {url}')
-        req = requests.get(url)
+        req = transport.get(url)
         dataset.success = req.status_code == 200
         print(f'dataset: {dataset.success}')
         if len(req.text) < 500:
@@ -344,8 +356,9 @@ class Manager(ManagerBase):
             # print(f'json: {len(req.json())}')
             with open(fullpath, 'w') as fh:
                 fh.write(req.text)
+        dataset.sha256 = None
         dataset.save()
-        return req.text, dataset
+        return self.columnar_resource(dataset), dataset
 
 
 class CookGISManager(ManagerBase):
@@ -404,7 +417,6 @@ class CookGISManager(ManagerBase):
         return True
 
     # need to refactor and combine this
-    # This could return a filename or a live object
     def fetch_resource(self, id_):
         self.rebind()
         dataset: DataSet | None = DataSet.get_or_none(DataSet.id_ == id_)
@@ -418,6 +430,7 @@ class CookGISManager(ManagerBase):
             ext = 'geojson'
         filename = sanitize_filename.sanitize(f'{dataset.name}.{ext}')
         fullpath = os.path.join(self.catalog.destination_dir, filename)
+        dataset.fullpath = fullpath
         if os.path.exists(fullpath):
             print(f'Skipping fetch because {fullpath} exists')
             print(f'Retrieved: {dataset.retrieved}')
@@ -425,7 +438,7 @@ class CookGISManager(ManagerBase):
             print(f'Updated: {dataset.updated}')
             print(f'Data updated: {dataset.data_updated}')
             print(f'Metadata updated: {dataset.metadata_updated}')
-            return open(fullpath).read(), dataset
+            return self.columnar_resource(dataset), dataset
         dataset.retrieved = fetch_time
         # heuristic: mistrust updated too close to retrieved time?
         print(f'Fetching {filename}')
@@ -435,7 +448,7 @@ class CookGISManager(ManagerBase):
             return None
         url = dataset.url
         print(f'Fetching {url}')
-        req = requests.get(url)
+        req = transport.get(url)
         dataset.success = req.status_code == 200
         print(f'dataset: {dataset.success}')
         if len(req.text) < 500:
@@ -445,8 +458,9 @@ class CookGISManager(ManagerBase):
         print(f'json: {len(req.json())}')
         with open(fullpath, 'w') as fh:
             fh.write(req.text)
+        dataset.sha256 = None
         dataset.save()
-        return req.text, dataset
+        return self.columnar_resource(dataset), dataset
 
 # pandas join dataset series
 
@@ -466,16 +480,30 @@ class PipelineFetcher(PipelineInterface):
     def __init__(self, stage_info):
         super().__init__(stage_info)
         self.rv = PipelineResult()
-        
+
+    def read_options(self) -> dict:
+        """
+        Pushes keep_cols, equality filters and an optional bbox down into the sidecar reader so
+        that unneeded columns and rows are not materialized (for the bbox, only with sidecars
+        that store geometry bounds).
+
+        :return: Keyword arguments for columnar.read_sidecar
+        """
+        ds: dict = self.stage_info['parameters']['datasource']
+        opts = {}
+        keep_cols = ds.get('keep_cols')
+        if keep_cols:
+            opts['columns'] = keep_cols
+        filters = [(f['column'], f['value']) for f in ds.get('filter', []) if 'keep' in f['action']]
+        if filters:
+            opts['filters'] = filters
+        bbox = ds.get('bbox')
+        if bbox:
+            opts['bbox'] = tuple(bbox)
+        return opts
+
     def apply_filters(self):
         ds: dict = self.stage_info['parameters']['datasource']
-        filters = ds.get('filter', [])
-        for f in filters:
-            col = f['column']
-            val = f['value']
-            action = f['action']
-            if 'keep' in action:
-                self.rv.obj = self.rv.obj[self.rv.obj[col] == val]
         keep_cols = ds.get('keep_cols')
         if keep_cols:
             self.rv.obj = self.rv.obj[keep_cols]
@@ -488,12 +516,8 @@ class PipelineFetcher(PipelineInterface):
         mm = cataloginfo.manager(cataloginfo, limit)
         mm.db_initialize()
         tup = mm.fetch_resource(ds['feed_id'])
-        rawsource, _ = tup
-        if type(rawsource) is bytes:
-            self.rv.obj = geopandas.read_file(io.BytesIO(rawsource))
-        else:
-            self.rv.obj = geopandas.read_file(io.StringIO(rawsource))
-        # need to do filtering
+        path, _ = tup
+        self.rv.obj = columnar.read_sidecar(path, **self.read_options())
         self.apply_filters()
         return self.rv
 
@@ -519,6 +543,8 @@ if __name__ == "__main__":
     parser.add_argument('--domain', nargs=1, required=False, default=['chicago'])
     parser.add_argument('--dump', action='store_true')
     parser.add_argument('--limit', nargs=1, type=int, default=[200000000])
+    parser.add_argument('--output', nargs=1, required=False, default=['/tmp/combined'])
+    parser.add_argument('--workers', nargs=1, type=int, default=[4])
     args = parser.parse_args()
     catalog = None
     # really?
@@ -559,23 +585,15 @@ if __name__ == "__main__":
         for ds in q:
             print(f'{ds.id_}  {ds.resource_type:12} {ds.name}')
     if args.series:
-        dfs = []
-        for k in args.key:
-            r, dataset = m.fetch_resource(k)
-            df = pd.read_json(io.StringIO(r))
-            df['dataset'] = dataset.name
-            dfs.append(df)
-        combined = pd.concat(dfs, axis=0, ignore_index=True)
-        print(combined['dataset'])
-        combined.to_json('/tmp/combined.json')
+        with ThreadPoolExecutor(max_workers=args.workers[0]) as executor:
+            fetched = list(executor.map(m.fetch_resource, args.key))
+        sources = [(dataset.name, path) for path, dataset in fetched]
+        combined = columnar.write_series(sources, args.output[0], workers=args.workers[0])
+        print(f'Wrote {len(sources)} datasets to {combined}')
     else:
         for k in args.key:
-            r, ds = m.fetch_resource(k)
-            if ds.resource_type == 'map':
-                import geopandas
-                gdf = geopandas.read_file(io.StringIO(r))
-            elif ds.fullpath.endswith('.zip'):
-                gdf = geopandas.read_file(f'zip:///{ds.fullpath}')
+            path, ds = m.fetch_resource(k)
+            gdf = columnar.read_sidecar(path)
 
         #q = DataSet.select().join(Category).where(DataSet.id_ == k)
         #for ds in q:
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+"""
+Normalized columnar (GeoParquet) copies of downloaded datasets.
+
+Raw downloads are parsed once and written next to the original file as
+.columnar/<sha256>.parquet, keyed by the content hash of the raw file, so a
+refetch that returns identical content reuses the existing sidecar.
+
+Normalization
+- Socrata pseudo-geojson: geometry stored as GeoJSON dicts in a regular
+  column (usually the_geom) becomes a real geometry column
+- string columns that are entirely numeric, boolean or ISO timestamps are typed
+- nested values (location dicts, lists) are stored as JSON strings
+
+Geo sidecars also store the bounds of each geometry (BBOX_COLUMNS), so a bbox
+read is pushed down into the parquet reader as range filters.
+
+Series of sidecars (eg yearly permit datasets) can be appended into one
+parquet dataset partitioned by source dataset with write_series. Column names
+and types are unified across sources and rows are streamed in record batches.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+SIDECAR_DIR = '.columnar'
+BBOX_COLUMNS = ['_bbox_minx', '_bbox_miny', '_bbox_maxx', '_bbox_maxy']
+ISO_TIMESTAMP = re.compile(r'^\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?$')
+SERIES_BATCH_SIZE = 65536
+
+
+def content_hash(path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def sidecar_path(fullpath, sha256) -> Path:
+    return Path(fullpath).parent / SIDECAR_DIR / f'{sha256}.parquet'
+
+
+def is_geojson_dict(x) -> bool:
+    return isinstance(x, dict) and 'type' in x and 'coordinates' in x
+
+
+def type_column(s: pd.Series) -> pd.Series:
+    """
+    Converts an object column of strings to a typed column if every value allows it.
+    Values with leading zeros (zip codes, ward ids) are left as strings.
+    """
+    values = s.dropna()
+    if values.empty or not values.map(lambda x: isinstance(x, str)).all():
+        return s
+    lowered = values.str.lower()
+    if lowered.isin(['true', 'false']).all():
+        return lowered.reindex(s.index).map({'true': True, 'false': False}).astype('boolean')
+    if values.str.match(ISO_TIMESTAMP).all():
+        return pd.to_datetime(s, errors='coerce')
+    if values.str.match(r'^0\d').any():
+        return s
+    try:
+        return pd.to_numeric(s)
+    except (ValueError, TypeError):
+        return s
+
+
+def normalize_frame(df: pd.DataFrame) -> pd.DataFrame:
+    geometry_col = None
+    for c in df.columns:
+        if isinstance(df, gpd.GeoDataFrame) and c == df.geometry.name:
+            continue
+        if not pd.api.types.is_string_dtype(df[c].dtype):
+            continue
+        values = df[c].dropna()
+        if geometry_col is None and not isinstance(df, gpd.GeoDataFrame) and not values.empty \
+                and values.map(is_geojson_dict).all():
+            geometry_col = c
+            continue
+        if values.map(lambda x: isinstance(x, (dict, list))).any():
+            df[c] = df[c].map(lambda x: json.dumps(x) if isinstance(x, (dict, list)) else x)
+            continue
+        df[c] = type_column(df[c])
+    if geometry_col:
+        geoms = df[geometry_col].map(lambda x: shapely.geometry.shape(x) if is_geojson_dict(x) else None)
+        df = gpd.GeoDataFrame(df.drop(columns=[geometry_col]), geometry=gpd.GeoSeries(geoms.values, index=df.index), crs=4326)
+    return df
+
+
+def read_raw(fullpath) -> pd.DataFrame:
+    fullpath = str(fullpath)
+    if fullpath.endswith('.zip'):
+        return gpd.read_file(f'zip://{fullpath}', engine='pyogrio', use_arrow=True)
+    if fullpath.endswith('.geojson'):
+        return gpd.read_file(fullpath, engine='pyogrio', use_arrow=True)
+    return pd.read_json(fullpath, dtype=False)
+
+
+def ensure_sidecar(fullpath, sha256=None) -> Path:
+    """
+    Builds the normalized sidecar for a raw download unless one already exists for its content.
+
+    :return: Path of the GeoParquet sidecar
+    """
+    if sha256 is None:
+        sha256 = content_hash(fullpath)
+    path = sidecar_path(fullpath, sha256)
+    if path.exists():
+        return path
+    print(f'Building columnar sidecar for {fullpath}')
+    os.makedirs(path.parent, exist_ok=True)
+    df = normalize_frame(read_raw(fullpath))
+    if isinstance(df, gpd.GeoDataFrame):
+        df = df.assign(**dict(zip(BBOX_COLUMNS, df.geometry.bounds.to_numpy().T)))
+    tmp = path.with_suffix('.tmp')
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+    return path
+
+
+def is_geo(path) -> bool:
+    return b'geo' in (pq.read_schema(path).metadata or {})
+
+
+def read_sidecar(path, columns=None, filters=None, bbox=None) -> pd.DataFrame:
+    """
+    Reads a sidecar, pushing column selection, equality filters and the bbox down into the parquet reader.
+
+    :param columns: Columns to read; geometry is always included for geo sidecars
+    :param filters: List of (column, value) pairs that rows must equal
+    :param bbox: Optional (minx, miny, maxx, maxy) in the sidecar CRS
+    """
+    filters = [(col, '=', val) for col, val in filters or []]
+    names = pq.read_schema(path).names
+    if columns is None:
+        columns = [c for c in names if c not in BBOX_COLUMNS]
+    if not is_geo(path):
+        return pd.read_parquet(path, columns=columns, filters=filters or None)
+    columns = [c for c in columns if c != 'geometry'] + ['geometry']
+    if bbox and all(c in names for c in BBOX_COLUMNS):
+        minx, miny, maxx, maxy = bbox
+        filters += [('_bbox_maxx', '>=', minx), ('_bbox_minx', '<=', maxx),
+                    ('_bbox_maxy', '>=', miny), ('_bbox_miny', '<=', maxy)]
+    df = gpd.read_parquet(path, columns=columns, filters=filters or None)
+    if bbox:
+        # the bounds filter keeps overlapping bounds; this keeps geometries that intersect, and is the only
+        # bbox filter for sidecars written without bounds
+        minx, miny, maxx, maxy = bbox
+        df = df.cx[minx:maxx, miny:maxy]
+    return df
+
+
+def normalize_name(name: str) -> str:
+    """
+    Maps column name variants across a series (Permit Type, PERMIT_TYPE, permit_type_) to one name.
+    """
+    return re.sub(r'[^0-9a-z]+', '_', name.strip().lower()).strip('_')
+
+
+def unify_types(types) -> pa.DataType:
+    types = [t for t in types if not pa.types.is_null(t)]
+    if not types:
+        return pa.null()
+    first = types[0]
+    if all(t == first for t in types):
+        return first
+    if all(pa.types.is_integer(t) for t in types):
+        return pa.int64()
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+        return pa.float64()
+    if all(pa.types.is_timestamp(t) for t in types):
+        return pa.timestamp('us')
+    if all(pa.types.is_binary(t) or pa.types.is_large_binary(t) for t in types):
+        return pa.large_binary()
+    return pa.large_string()
+
+
+def unified_schema(paths):
+    """
+    Reads only the parquet footers of the series and produces a schema that every source can be cast to.
+
+    :return: Unified schema, including GeoParquet metadata from the first geo source
+    """
+    fields = {}
+    geo = None
+    for path in paths:
+        schema = pq.read_schema(path)
+        if geo is None and schema.metadata and b'geo' in schema.metadata:
+            geo = schema.metadata[b'geo']
+        for f in schema:
+            if f.name in BBOX_COLUMNS:
+                continue
+            fields.setdefault(normalize_name(f.name), []).append(f.type)
+    schema = pa.schema([pa.field(name, unify_types(types)) for name, types in fields.items()])
+    if geo is not None:
+        schema = schema.with_metadata({b'geo': geo})
+    return schema
+
+
+def append_partition(path, outdir, partition_value, schema: pa.Schema, batch_size=SERIES_BATCH_SIZE, part=0):
+    """
+    Streams one sidecar into outdir/dataset=<partition_value>/part-<part>.parquet in record batches cast to
+    the unified schema.
+    """
+    partdir = Path(outdir) / f'dataset={urllib.parse.quote(partition_value, safe="")}'
+    os.makedirs(partdir, exist_ok=True)
+    source = pq.ParquetFile(path)
+    with pq.ParquetWriter(partdir / f'part-{part}.parquet', schema) as writer:
+        for batch in source.iter_batches(batch_size=batch_size):
+            columns = {}
+            for name, column in zip(batch.schema.names, batch.columns):
+                columns.setdefault(normalize_name(name), column)
+            arrays = []
+            for f in schema:
+                column = columns.get(f.name)
+                if column is None:
+                    arrays.append(pa.nulls(batch.num_rows, type=f.type))
+                else:
+                    arrays.append(column.cast(f.type))
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+
+
+def is_series(outdir) -> bool:
+    """
+    :return: Whether outdir is a directory holding only dataset=<name> partitions, as written by write_series
+    """
+    outdir = Path(outdir)
+    return outdir.is_dir() and all(p.is_dir() and p.name.startswith('dataset=') for p in outdir.iterdir())
+
+
+def write_series(sources, outdir, workers=None, batch_size=SERIES_BATCH_SIZE) -> Path:
+    """
+    Appends a series of sidecars into a parquet dataset partitioned by source dataset.
+    Memory use is bounded by the batch size per worker regardless of the number of sources.
+
+    :param sources: List of (dataset name, sidecar path)
+    :param outdir: Output directory; an existing one is only replaced if it holds an earlier series
+    :return: Output directory, readable with pyarrow.parquet.read_table or geopandas.read_parquet
+    """
+    outdir = Path(outdir)
+    if outdir.exists() and not is_series(outdir):
+        raise FileExistsError(f'{outdir} exists and is not a series output')
+    tmp = outdir.with_name(f'{outdir.name}.tmp-{os.getpid()}')
+    os.makedirs(tmp)
+    try:
+        schema = unified_schema([path for _, path in sources])
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # sources with the same dataset name share a partition, each in its own part file
+            futures = [executor.submit(append_partition, path, tmp, name, schema, batch_size, part)
+                       for part, (name, path) in enumerate(sources)]
+            for future in futures:
+                future.result()
+    except BaseException:
+        shutil.rmtree(tmp)
+        raise
+    if outdir.exists():
+        shutil.rmtree(outdir)
+    os.rename(tmp, outdir)
+    return outdir
+
+
+if __name__ == "__main__":
+    print(ensure_sidecar(sys.argv[1]))
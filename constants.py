@@ -12,6 +12,10 @@ class ConfigReader:
             self.datasets = config['datasets_path']
             self.shapefile = config['shapefile_path']
             self.pipeline_cache = config['pipeline_cache_path']
+            self.cassettes = config.get('cassette_path', '~/tmp/cassettes')
+            self.http_transport = config.get('http_transport', 'live')
+            self.simulated_latency = config.get('simulated_latency', 0.0)
+            self.simulated_bandwidth = config.get('simulated_bandwidth')
 
 
 configreader = ConfigReader()
@@ -27,3 +31,7 @@ def shapefile_path():
 
 def pipeline_cache_path():
     return Path(configreader.pipeline_cache).expanduser()
+
+
+def cassette_path():
+    return Path(configreader.cassettes).expanduser()
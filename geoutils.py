@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import constants
+
+# Bikemap layers are kept in this CRS between stages and only projected for output
+WORKING_CRS = constants.CHICAGO_DATUM
+
+_projected = {}
+
+
+def to_crs(gdf: gpd.GeoDataFrame, crs) -> gpd.GeoDataFrame:
+    """
+    Memoized projection: each layer object is projected to a given CRS at most once per run.
+    Layers already in the CRS are returned as is. Projected layers are treated as immutable;
+    the memo entry is dropped when the source layer is garbage collected.
+    """
+    if gdf.crs == crs:
+        return gdf
+    key = (id(gdf), str(crs))
+    hit = _projected.get(key)
+    if hit is not None and hit[0]() is gdf:
+        return hit[1]
+    projected = gdf.to_crs(crs)
+    _projected[key] = (weakref.ref(gdf), projected)
+    weakref.finalize(gdf, _projected.pop, key, None)
+    return projected
+
+
+def segmentize(gdf: gpd.GeoDataFrame, max_length=None) -> gpd.GeoDataFrame:
+    """
+    Splits LineStrings into 2-point segments in one pass over the coordinate array.
+
+    Every segment keeps the attributes of its line and gains
+    - parent: index label of the original line
+    - si: 1-based sequence number of the segment within the line
+    - seg_length: segment length in CRS units
+
+    :param gdf: LineStrings only
+    :param max_length: If set, lines no longer than this are kept whole (si 0)
+    :return: Segments ordered by line, then sequence
+    """
+    geoms = gdf.geometry.values
+    assert (shapely.get_type_id(geoms) == shapely.GeometryType.LINESTRING).all()
+    lengths = shapely.length(geoms)
+    split = np.ones(len(gdf), dtype=bool) if max_length is None else lengths > max_length
+    coords, idx = shapely.get_coordinates(geoms, return_index=True)
+    starts = np.nonzero((idx[1:] == idx[:-1]) & split[idx[:-1]])[0]
+    parents = idx[starts]
+    segs = shapely.linestrings(np.stack([coords[starts], coords[starts + 1]], axis=1))
+
+    pieces = gdf.iloc[parents].copy()
+    pieces['parent'] = gdf.index[parents]
+    pieces['si'] = starts - np.searchsorted(idx, parents) + 1
+    pieces['seg_length'] = shapely.length(segs)
+    pieces[gdf.geometry.name] = gpd.GeoSeries(segs, index=pieces.index, crs=gdf.crs)
+    pieces['_pos'] = parents
+
+    whole = gdf[~split].copy()
+    whole['parent'] = whole.index
+    whole['si'] = 0
+    whole['seg_length'] = lengths[~split]
+    whole['_pos'] = np.nonzero(~split)[0]
+
+    rv = pd.concat([pieces, whole]).sort_values(['_pos', 'si'], kind='stable')
+    return rv.drop(columns='_pos').reset_index(drop=True)
+
+
+class BoundaryClipper:
+    """
+    Clips layers to a boundary geometry that is built, unioned and prepared once.
+
+    Modes:
+    - polygon: union of the boundary polygons
+    - envelope: union of the envelopes of each boundary feature
+    - bounds: total bounding box of the boundary layer
+
+    Candidates come from the layer's spatial index. Features entirely inside the boundary are kept
+    as is; only features crossing it are intersected, in chunks across threads (shapely releases
+    the GIL). Clippers are cached by boundary content, selection and mode.
+    """
+    MODES = ('polygon', 'envelope', 'bounds')
+    CHUNK = 20000
+    cache = {}
+
+    def __init__(self, geometry, mode):
+        assert mode in self.MODES
+        self.geometry = geometry
+        self.mode = mode
+        shapely.prepare(self.geometry)
+
+    @classmethod
+    def for_boundaries(cls, boundaries: gpd.GeoDataFrame, field=None, values=None, mode='polygon', crs=None):
+        """
+        :param field: Optional column to select boundary features by
+        :param values: Values of field to keep
+        :param crs: CRS of the layers that will be clipped; defaults to the boundary CRS
+        """
+        if field is not None:
+            boundaries = boundaries[boundaries[field].isin(values)]
+        if crs is not None:
+            boundaries = to_crs(boundaries, crs)
+        if mode == 'bounds':
+            content = repr(tuple(boundaries.total_bounds)).encode('utf-8')
+        else:
+            content = b''.join(shapely.to_wkb(boundaries.geometry.values))
+        key = (hashlib.sha256(content).hexdigest(), str(boundaries.crs), mode)
+        clipper = cls.cache.get(key)
+        if clipper is None:
+            geoms = boundaries.geometry.values
+            if mode == 'polygon':
+                geometry = shapely.union_all(geoms)
+            elif mode == 'envelope':
+                geometry = shapely.union_all(shapely.envelope(geoms))
+            else:
+                geometry = shapely.box(*boundaries.total_bounds)
+            clipper = cls(geometry, mode)
+            cls.cache[key] = clipper
+        return clipper
+
+    def intersect(self, geoms, workers=None):
+        if self.mode == 'bounds':
+            clip = lambda g: shapely.clip_by_rect(g, *self.geometry.bounds)
+        else:
+            clip = lambda g: shapely.intersection(g, self.geometry)
+        if len(geoms) <= self.CHUNK:
+            return clip(geoms)
+        chunks = np.array_split(geoms, int(np.ceil(len(geoms) / self.CHUNK)))
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            return np.concatenate(list(executor.map(clip, chunks)))
+
+    def clip(self, gdf: gpd.GeoDataFrame, workers=None) -> gpd.GeoDataFrame:
+        candidates = np.sort(gdf.sindex.query(self.geometry, predicate='intersects'))
+        rv = gdf.iloc[candidates].copy()
+        geoms = np.asarray(rv.geometry.values)
+        crossing = ~shapely.contains(self.geometry, geoms)
+        if crossing.any():
+            geoms = geoms.copy()
+            geoms[crossing] = self.intersect(geoms[crossing], workers)
+            rv[rv.geometry.name] = gpd.GeoSeries(geoms, index=rv.index, crs=gdf.crs)
+        return rv[~rv.geometry.is_empty]
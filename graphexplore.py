@@ -4,14 +4,17 @@ import sys
 from types import SimpleNamespace
 from typing import List, Tuple
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import networkx as nx
 import momepy
-import shapely
-import tqdm
 
 import constants
+import geoutils
+import routing
+from map_processor import SuitabilityRules
+from pipeline_interface import PipelineResult
 from constants import datasets_path
 
 
@@ -32,20 +35,7 @@ def dfline(gdf):
     :param gdf:
     :return:
     """
-    df = gpd.GeoDataFrame()
-    df.crs = 4326
-    for _, f in gdf.iterrows():
-        t = f.to_dict()
-        g = f.geometry
-        assert g.geom_type == 'LineString'
-        prev = None
-        for i, c in enumerate(g.coords):
-            if prev is not None:
-                t['si'] = i
-                t['geometry'] = shapely.LineString([prev, c])
-                df = pd.concat([df, gpd.GeoDataFrame([t])])
-            prev = c
-    return df
+    return geoutils.segmentize(gdf)
 
 
 def subgraph_analyze(g):
@@ -65,90 +55,150 @@ def subgraph_analyze(g):
 class NxFinder2:
     # big weight meaning don't use this edge
     MAX = 1000000000
-
-    def __init__(self, network_gdf, points_gdf, silent=False, sample=None):
+    # meters
+    SNAP_DISTANCE = 20
+
+    def __init__(self, network_gdf, points_gdf, silent=False, sample=None, graph_key=None, unreachable='skip',
+                 contract=True, seed=None, rules: SuitabilityRules = None):
+        """
+        :param seed: Random state of the point sample
+        :param rules: Suitability rules the network weights were computed with, for weight profiles
+        :param graph_key: If set, the compiled graph is loaded from or saved to the graph store under this key
+        :param unreachable: skip: pairs between disconnected parts of the network are counted and skipped;
+                            reassign: points only snap to the largest strongly connected component
+        :param contract: Route on the graph with pass-through chains contracted, keeping the snapped nodes
+        """
         self.gdf = network_gdf
         self.points_df = points_gdf
-        self.gdf_alt = self.gdf.to_crs(constants.CHICAGO_DATUM)
+        self.gdf_alt = geoutils.to_crs(self.gdf, constants.CHICAGO_DATUM)
         if sample and sample < len(self.points_df):
             print(f'Sampling original size {len(self.points_df)} to {sample}')
-            self.points_df = self.points_df.sample(sample)
-        self.points_alt = self.points_df.to_crs(constants.CHICAGO_DATUM)
+            self.points_df = self.points_df.sample(sample, random_state=seed)
+        self.points_alt = geoutils.to_crs(self.points_df, constants.CHICAGO_DATUM)
         self.silent = silent
-        self.pointrow_cache = {}
+        self.rules = rules or SuitabilityRules()
         filt = self.gdf_alt[self.gdf_alt.geometry.geom_type == 'LineString']
-        self.graph = momepy.gdf_to_nx(filt, approach='primal', oneway_column='bike_ow', directed=True, length='actual')
-        self.graph_index = {}
-        for e in self.graph.edges(data=True):
-            k = e[2]['trans_id']
-            v = (e[0], e[1])
-            self.graph_index[k] = v
-
-    def closest_point2(self, pointrow):
-        p = pointrow.iloc[0].geometry
-        cached = self.pointrow_cache.get(p)
-        if cached is not None:
-            return cached
-        alt = self.gdf_alt.clip(pointrow.geometry.buffer(20))
-        if alt.empty:
-            self.pointrow_cache[p] = gpd.GeoDataFrame()
-            return gpd.GeoDataFrame()
-        alt = alt.sample(1)
-        rv = self.gdf[self.gdf.trans_id == alt.trans_id.iloc[0]].iloc[0]
-        self.pointrow_cache[p] = rv
-        return rv
-
-    def edge_datas(self, path):
-        previous = None
-        for p1 in path:
-            if previous:
-                yield self.graph.get_edge_data(previous, p1)
-            previous = p1
-
-    @staticmethod
-    def path_weight(e0, e1, raw):
-        attrs = list(raw.values())[0]
-        return attrs['weight']
-        # suitability_multipliers = {
-        #     2: 5.0,
-        #     3: 2.0,
-        #     4: 0.9,
-        #     5: 1,
-        #     6: 0.75,
-        #     7: 0.6,
-        #     8: 0.5,
-        # }
-        # weight = attrs['actual']
-        # mult = suitability_multipliers.get(attrs['suitability'], 0)
-        # #print(f'Path weight: {weight} m{mult} E{e0} {e1} {raw}')
-        # if mult == 0:
-        #     return NxFinder.MAX
-        # return weight * mult
+        self.edges = filt
+        self.graph_key = graph_key
+        if graph_key:
+            self.base_graph = routing.GraphStore().load_or_compile(graph_key, filt, max_weight=self.MAX)
+        else:
+            self.base_graph = routing.CompiledGraph.from_gdf(filt, max_weight=self.MAX)
+        self.snapped_edge, self.snapped_node = self.base_graph.snap(
+            filt.geometry.values, self.points_alt.geometry.values, self.SNAP_DISTANCE)
+        self.reassigned = 0
+        if unreachable == 'reassign':
+            nearest = self.snapped_edge
+            self.snapped_edge, self.snapped_node = self.base_graph.snap(
+                filt.geometry.values, self.points_alt.geometry.values, self.SNAP_DISTANCE,
+                self.base_graph.main_component_edges())
+            self.reassigned = int(np.count_nonzero((nearest >= 0) & (self.snapped_edge != nearest)))
+        self.contract = contract
+        self.graph = self.routing_graph(self.base_graph)
+        self._query = None
+        self.node_index = {}
+
+    @property
+    def query(self) -> routing.RouteQuery:
+        """
+        Point to point queries; built on first use, since analyses that only count routes never need it
+        """
+        if self._query is None:
+            self._query = routing.RouteQuery(self.graph, self.edges)
+        return self._query
+
+    def routing_graph(self, base_graph: routing.CompiledGraph) -> routing.CompiledGraph:
+        if not self.contract:
+            return base_graph
+        # snapped nodes are terminals, so they all survive contraction
+        return base_graph.contract(self.snapped_node[self.snapped_node >= 0])
+
+    def edge_weights(self, multipliers: dict) -> np.ndarray:
+        """
+        :param multipliers: Suitability multipliers of a weight profile
+        """
+        return self.rules.weight(self.edges['actual'].astype(float), self.edges['suitability'], multipliers)
+
+    def weighted_graph(self, weights) -> routing.CompiledGraph:
+        """
+        Routing graph on the same topology and snapped points with other edge weights.
+        """
+        base = self.base_graph.reweight(weights, routing.CompiledGraph.twoway(self.edges), self.MAX)
+        return self.routing_graph(base)
+
+    def diagnostics(self, graph=None, weights=None) -> dict:
+        graph = graph or self.graph
+        weights = pd.Series(self.edges['weight'] if weights is None else weights).astype(float)
+        return {
+            **graph.summary(),
+            'prohibited_edges': int(((weights >= self.MAX) | weights.isna()).sum()),
+            'points': len(self.points_alt),
+            'unsnapped_points': int(np.count_nonzero(self.snapped_node < 0)),
+            'reassigned_points': self.reassigned,
+        }
+
+    def point_nodes(self, colname) -> pd.Series:
+        """
+        :return: Snapped node (base graph id) of each point id (first point with the id),
+                 -1 if the point did not snap
+        """
+        nodes = self.node_index.get(colname)
+        if nodes is None:
+            nodes = pd.Series(self.snapped_node, index=self.points_alt[colname].to_numpy())
+            nodes = nodes[~nodes.index.duplicated()]
+            self.node_index[colname] = nodes
+        return nodes
+
+    def edge_datas(self, edges):
+        return self.edges.iloc[edges].to_dict('records')
+
+    def snap_pairs(self, colname, tups: List[Tuple[str, str]]):
+        """
+        :return: (origin, destination) node pairs and the 1-based positions in tups of the pairs
+                 where both points snapped to the network
+        """
+        tups = np.asarray(list(tups), dtype=object).reshape(-1, 2)
+        nodes = self.point_nodes(colname)
+        start = self.graph.routing_nodes(nodes.reindex(tups[:, 0]).fillna(-1).to_numpy(dtype=np.int64))
+        end = self.graph.routing_nodes(nodes.reindex(tups[:, 1]).fillna(-1).to_numpy(dtype=np.int64))
+        snapped = (start >= 0) & (end >= 0)
+        pairs = np.stack([start[snapped], end[snapped]], axis=1)
+        positions = np.flatnonzero(snapped) + 1
+        return pairs, positions
 
     def route_edges(self, colname, tups: List[Tuple[str, str]], full=False):
-        points = []
-        count = 0
-        for start, end in tqdm.tqdm(tups):
-            count += 1
-            startpoint = self.closest_point2(self.points_alt[self.points_alt[colname] == start])
-            endpoint = self.closest_point2(self.points_alt[self.points_alt[colname] == end])
-            if startpoint.empty or endpoint.empty:
+        """
+        Routes point pairs on the compiled graph, one shortest path tree per origin.
+        Results come grouped by origin rather than in input order.
+
+        :return: Iterator of (edge attribute dicts if full else trans_ids, 1-based position of the pair)
+        """
+        pairs, positions = self.snap_pairs(colname, tups)
+        for pos, edges in self.graph.route(pairs):
+            if edges is None:
+                print(f'No path: fail {pairs[pos][0]} {pairs[pos][1]}')
                 continue
-            startnode = self.graph_index[startpoint['trans_id']][0]
-            endnode = self.graph_index[endpoint['trans_id']][0]
-            # needs weighting function
-            try:
-                path = nx.shortest_path(self.graph, startnode, endnode, weight=self.path_weight)
-                if not path:
-                    print(f'Fail {startnode} {endnode}')
-                    continue
-                #print(path)
-                if full:
-                    yield [list(x.values())[0] for x in self.edge_datas(path)], count
-                else:
-                    yield [list(x.values())[0]['trans_id'] for x in self.edge_datas(path)], count
-            except nx.exception.NetworkXNoPath:
-                print(f'No path: fail {startnode} {endnode}')
+            if full:
+                yield self.edge_datas(edges), positions[pos]
+            else:
+                yield list(self.graph.trans_id[edges]), positions[pos]
+
+    def route_query(self, colname, tups: List[Tuple[str, str]]) -> List[routing.RouteResult | None]:
+        """
+        Routes with cost and segment attributes: A* for a single pair, shared shortest path trees for more.
+
+        :return: Result per pair, None if a point did not snap or there is no path
+        """
+        nodes = self.point_nodes(colname)
+        pairs = [tuple(self.graph.routing_nodes([nodes.get(start, -1), nodes.get(end, -1)])) for start, end in tups]
+        snapped = [i for i, (a, b) in enumerate(pairs) if a >= 0 and b >= 0]
+        results = [None] * len(pairs)
+        if len(snapped) == 1:
+            results[snapped[0]] = self.query.route(*pairs[snapped[0]])
+        elif snapped:
+            for i, r in zip(snapped, self.query.route_many([pairs[i] for i in snapped])):
+                results[i] = r
+        return results
 
 
 class NxFinder(NxFinder2):
@@ -156,7 +206,9 @@ class NxFinder(NxFinder2):
     MAX = 1000000000
 
     def __init__(self, network_filename, points_filename, silent=False, sample=None):
-        super().__init__(gpd.read_file(network_filename), gpd.read_file(points_filename), silent, sample)
+        # either may be a pipeline cache file (GeoParquet) or a plain vector file
+        super().__init__(PipelineResult.from_cached(network_filename, 'geopandas.GeoDataFrame').get(),
+                         PipelineResult.from_cached(points_filename, 'geopandas.GeoDataFrame').get(), silent, sample)
 
 
 def schooltest():
@@ -166,13 +218,17 @@ def schooltest():
     #rj = f.router('school_nm', 'LAKE VIEW HS', 'LASALLE')
     #rj = f.router('school_nm', 'LASALLE', 'LAKE VIEW HS')
 
-    for r, _ in f.route_edges('school_nm', [('LASALLE', 'LAKE VIEW HS'), ('PRESCOTT', 'NEWBERRY')], full=True):
-        print(f'Route')
-        for rr in r:
-            print(f' Rt {rr}')
+    tups = [('LASALLE', 'LAKE VIEW HS'), ('PRESCOTT', 'NEWBERRY')]
+    for (start, end), r in zip(tups, f.route_query('school_nm', tups)):
+        if r is None:
+            print(f'No route {start} -> {end}')
+            continue
+        print(f'Route {start} -> {end}: cost {r.cost:.1f}, {len(r.trans_ids)} segments in {r.elapsed_ms:.1f} ms')
+        for _, seg in r.edges.iterrows():
+            print(f' Rt {seg.trans_id}: {seg.street_nam} {seg.suitability} {seg.weight:.1f}')
 
 def graphtest():
-    gdf = gpd.read_file(sys.argv[1])
+    gdf = PipelineResult.from_cached(sys.argv[1], 'geopandas.GeoDataFrame').get()
     filt = gdf[gdf.geometry.type == 'LineString']
     proj = filt.to_crs(constants.CHICAGO_DATUM)
     G = momepy.gdf_to_nx(proj, approach='primal', oneway_column='bike_ow', directed=True, length='actual')
@@ -4,8 +4,8 @@ import datetime
 import io
 import os
 import glob
+import hashlib
 import sys
-import copy
 import json
 
 from abc import abstractmethod, ABC
@@ -14,12 +14,10 @@ from typing import Dict, List, Tuple, Callable
 
 from peewee import SqliteDatabase, Model, CharField, DateTimeField
 import geopandas
-import shapely
-import geopandas as gpd
+import numpy as np
 import pandas as pd
-import tqdm
 
-import constants
+import geoutils
 from pipeline_interface import PipelineInterface, PipelineResult
 from constants import datasets_path, shapefile_path
 
@@ -32,6 +30,39 @@ from constants import datasets_path, shapefile_path
 """
 
 
+# Compact dtypes for the bikemap layers, enforced on every bikemap stage output
+BIKEMAP_SCHEMA = {
+    'street_nam': 'category',
+    'st_name': 'category',
+    'street_typ': 'category',
+    'ewns_dir': 'category',
+    'dir_travel': 'category',
+    'status': 'category',
+    'class': 'category',
+    'displayrou': 'category',
+    'br_oneway': 'bool',
+    'contraflow': 'bool',
+    'bike_ow': 'bool',
+    'suitability': 'int8',
+}
+
+
+def enforce_schema(df, schema=None):
+    """
+    Converts the schema columns present in df to their declared dtypes.
+    Y/N flags become booleans; missing flags are False.
+    """
+    schema = schema or BIKEMAP_SCHEMA
+    for column, dtype in schema.items():
+        if column not in df.columns:
+            continue
+        if dtype == 'bool':
+            df[column] = df[column].astype(str).str.upper().isin(['Y', 'TRUE'])
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
 @dataclass(frozen=True)
 class DataSource:
     domain: str
@@ -41,46 +72,120 @@ class DataSource:
     keep_cols: frozenset[str] = frozenset()
 
 
+class CompiledOverrides:
+    """
+    The transformations for one source, in file order, with runs of the same kind batched so each
+    run is applied in one vectorized step:
+    - removals by key or filter value on one column: one isin
+    - updates by key or filter value of one (match column, update column): one map
+
+    Override values are converted to the dtype of the column they match, so ids written as strings
+    still apply to numeric columns and the other way around.
+    """
+    def __init__(self, key: str, transformations: list):
+        self.key = key
+        # ('remove', column, [values]) or ('update', (column, update column), {value: new value})
+        self.steps = []
+        for t in transformations:
+            if 'key' in t:
+                column, value = key, t['key']
+            elif 'filter' in t:
+                column, value = t['filter']['column'], t['filter']['value']
+            else:
+                continue
+            action = t['action']
+            if action == 'remove':
+                step = ('remove', column)
+            elif 'update' in action:
+                step = ('update', (column, action['update']['column']))
+            else:
+                continue
+            if not self.steps or self.steps[-1][:2] != step:
+                self.steps.append((*step, {}))
+            # later updates of the same value win, as if applied one by one
+            self.steps[-1][2][value] = action['update']['value'] if step[0] == 'update' else True
+
+    @classmethod
+    def typed(cls, values, dtype) -> dict:
+        """
+        :return: Override value -> value in dtype, for the values that convert
+        """
+        if isinstance(dtype, pd.CategoricalDtype):
+            return cls.typed(values, dtype.categories.dtype)
+        if pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+            return {v: str(v) for v in values}
+        converted = {}
+        for v in values:
+            try:
+                converted[v] = pd.Series([v]).astype(dtype).iloc[0]
+            except (ValueError, TypeError):
+                pass
+        return converted
+
+    @staticmethod
+    def comparable(column: pd.Series) -> pd.Series:
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            column = column.astype(column.dtype.categories.dtype)
+        if pd.api.types.is_object_dtype(column.dtype):
+            return column.astype(str)
+        return column
+
+    def apply(self, df):
+        """
+        :return: Transformed frame and the list of (column, value) overrides that matched no rows
+        """
+        unmatched = []
+        for kind, columns, mapping in self.steps:
+            column = columns if kind == 'remove' else columns[0]
+            values = self.comparable(df[column])
+            typed = self.typed(mapping.keys(), values.dtype)
+            matched = values.isin(list(typed.values())).to_numpy()
+            found = set(values[matched])
+            unmatched += [(column, v) for v in mapping if v not in typed or typed[v] not in found]
+            if kind == 'remove':
+                df = df[~matched]
+            else:
+                new_values = {typed[v]: new for v, new in mapping.items() if v in typed}
+                df.loc[matched, columns[1]] = values[matched].map(new_values).to_numpy()
+        return df, unmatched
+
+
 class OverrideManager:
+    # compiled overrides keyed by content hash of the overrides file
+    compiled_cache: Dict[str, Dict[str, CompiledOverrides]] = {}
+
     def __init__(self):
         filepath = os.path.join(os.path.dirname(__file__), 'manual_overrides.json')
-        self.raw_overrides = json.load(open(filepath))
+        with open(filepath, 'rb') as fh:
+            raw = fh.read()
+        self.content_hash = hashlib.sha256(raw).hexdigest()
+        self.raw_overrides = json.loads(raw)
         self.sources = {}
+        self.unmatched = {}
         self.initialize()
 
     def initialize(self):
+        cached = self.compiled_cache.get(self.content_hash)
+        if cached is not None:
+            self.sources = cached
+            return
         for ov in self.raw_overrides['overrides']:
             if not ov.keys():
                 continue
             source_name = ov['source_id']['source']
             key_field = ov['source_id']['key']
-            #td = {}
-            self.sources[source_name] = {
-                'key': key_field,
-                'transformations': ov['transformations']
-            }
-            #for t in ov['transformations']:
-            #    td[t['key']] = t['action']
+            self.sources[source_name] = CompiledOverrides(key_field, ov['transformations'])
+        self.compiled_cache[self.content_hash] = self.sources
 
     def process(self, source, df):
-        transformation = self.sources.get(source)
-        if not transformation:
+        compiled = self.sources.get(source)
+        if not compiled:
             return df
-        key = transformation['key']
-        remove = []
-        for t in transformation['transformations']:
-            if 'key' in t:
-                if t['action'] == 'remove':
-                    remove.append(t['key'])
-            if 'filter' in t:
-                f = t['filter']
-                filtercol = f['column']
-                filterval = f['value']
-                if 'update' in t['action']:
-                    u = t['action']['update']
-                    # spurious SettingWithCopyWarning but it seems to work
-                    df.loc[df[filtercol] == filterval, u['column']] = u['value']
-        return df[~df[key].isin(remove)]
+        df, unmatched = compiled.apply(df)
+        self.unmatched[source] = unmatched
+        for column, value in unmatched:
+            print(f'Override for {source} matched nothing: {column} = {value}')
+        return df
 
 
 # unused
@@ -126,27 +231,14 @@ class StreetInfo:
         :param gdf:
         :return:
         """
-        df = gpd.GeoDataFrame()
-        df.crs = 4326
-        for _, f in gdf.iterrows():
-            t = f.to_dict()
-            g = f.geometry
-            assert g.geom_type == 'LineString'
-            prev = None
-            for i, c in enumerate(g.coords):
-                if prev is not None:
-                    t['si'] = i
-                    t['geometry'] = shapely.LineString([prev, c])
-                    df = pd.concat([df, gpd.GeoDataFrame([t])])
-                prev = c
-        return df
+        return geoutils.segmentize(gdf)
 
 # move these to different files
 class BikeStreetsWrapper:
     def __init__(self, df):
         self.orig = df
         # for the Chicago area, unit in meters
-        self.layer = self.orig.to_crs(epsg=26916)
+        self.layer = geoutils.to_crs(self.orig, geoutils.WORKING_CRS)
 
     def get_buffer(self):
         return self.layer.buffer(2)
@@ -173,9 +265,9 @@ class StreetsPreprocess(PipelineInterface):
     def run_stage(self) -> PipelineResult:
         centerlines = self.get_dependency('streets_fetch').get()
         centerlines = self.overrides.process('Street Center Lines', centerlines)
-        centerlines['trans_id'] = centerlines['trans_id'].apply(lambda x: f'A{x}')
+        centerlines['trans_id'] = 'A' + centerlines['trans_id'].astype(str)
         rv = PipelineResult()
-        rv.obj = centerlines
+        rv.obj = enforce_schema(geoutils.to_crs(centerlines, geoutils.WORKING_CRS))
         return rv
 
 
@@ -183,251 +275,229 @@ class BikeRoutesPreprocess(PipelineInterface):
     def __init__(self, stage_info):
         super().__init__(stage_info)
 
-    @staticmethod
-    def fix_bool(x):
-        if x and x.upper() == 'Y':
-            return 'Y'
-        return 'N'
-
-    @staticmethod
-    def bike_ow(x):
-        if x.contraflow == 'N' and x.br_oneway == 'Y':
-            return 'Y'
-        return 'N'
-
-    @staticmethod
-    def fix_street_name(street_name):
-        """
-        Converts bike lane street names to normalized Street Center Lines names
-        """
-        return {'AVENUE': 'AVENUE L',
-                'PLLYMOUTH': 'PLYMOUTH',
-                'MARTIN LUTHER KING JR': 'DR MARTIN LUTHER KING JR',
-                }.get(street_name, street_name).upper()
+    # Converts bike lane street names to normalized Street Center Lines names
+    STREET_NAME_FIXES = {
+        'AVENUE': 'AVENUE L',
+        'PLLYMOUTH': 'PLYMOUTH',
+        'MARTIN LUTHER KING JR': 'DR MARTIN LUTHER KING JR',
+    }
 
     def run_stage(self) -> PipelineResult:
         df = self.get_dependency('bike_routes_fetch').get()
         print(f'Processing with {df} src 0 (bike routes)')
-        for c in ['contraflow', 'br_oneway']:
-            df[c] = df[c].apply(self.fix_bool)
-        df['bike_ow'] = df.apply(self.bike_ow, axis=1)
-        df.st_name = df.st_name.apply(self.fix_street_name)
-        return PipelineResult(obj=df)
+        df.st_name = df.st_name.replace(self.STREET_NAME_FIXES).str.upper()
+        df = enforce_schema(df)
+        df['bike_ow'] = ~df.contraflow & df.br_oneway
+        return PipelineResult(obj=geoutils.to_crs(df, geoutils.WORKING_CRS))
 
 
 class OffStreetPreprocess(PipelineInterface):
     def __init__(self, stage_info):
         super().__init__(stage_info)
 
-    @staticmethod
-    def get_dicts(rd):
-        g = rd['geometry']
-        tid = rd['trans_id']
-        assert g.geom_type == 'LineString'
-        prev = None
-        count = 0
-        for i, c in enumerate(g.coords):
-            count += 1
-            if prev is not None:
-                rd['trans_id'] = f'{tid}-{count}'
-                rd['geometry'] = shapely.LineString([prev, c])
-                rd['actual'] = rd['geometry'].length
-                yield rd
-            prev = c
-
-
     def run_stage(self) -> PipelineResult:
         off_street: geopandas.GeoDataFrame = self.get_dependency('off_street_fetch').get()
         print(f'Off street {off_street}')
-        dds = []
-        off_street = off_street.to_crs(constants.CHICAGO_DATUM)
-        for _, row in off_street.iterrows():
-            if row.geometry.geom_type != 'LineString':
-                continue
-            id_ = row.FacName
-            if not id_:
-                id_ = row.Street
-            if not id_:
-                id_ = row.Sub_System
-            #rca = gpd.GeoDataFrame([row])
-            #rca.crs = 4326
-            #rc = rca.to_crs(constants.CHICAGO_DATUM)
-            rd = {'length': row.ShapeSTLength,
-                  'status': 'N',
-                  'dir_travel': 'B',
-                  'street_nam': id_,
-                  'trans_id': f'B{row.OBJECTID}',
-                  'geometry': row.geometry,
-                  'street_typ': '',
-                  'ewns_dir': '',
-                  'class': '4',
-                  'displayrou': 'OFF STREET',
-                  'st_name': id_,
-                  'br_oneway': 'N',
-                  'contraflow': 'N',
-                  'bike_ow': False,
-                  'actual': row.geometry.length}
-            if row.geometry.length > 200:
-                for d2 in self.get_dicts(rd):
-                    dds.append(copy.copy(d2))
-            else:
-                dds.append(copy.copy(rd))
-        offdf = geopandas.GeoDataFrame(dds)
-        offdf.crs = constants.CHICAGO_DATUM
-        #return offdf.to_crs(4326)
-        rv = PipelineResult()
-        return PipelineResult(obj=offdf)
+        max_segment_length = self.stage_info.get('parameters', {}).get('max_segment_length', 200)
+        off_street = geoutils.to_crs(off_street, geoutils.WORKING_CRS)
+        off_street = off_street[off_street.geometry.geom_type == 'LineString']
+        id_ = off_street.FacName.replace('', None)
+        id_ = id_.fillna(off_street.Street.replace('', None))
+        id_ = id_.fillna(off_street.Sub_System.replace('', None))
+        offdf = geopandas.GeoDataFrame({
+            'length': off_street.ShapeSTLength,
+            'status': 'N',
+            'dir_travel': 'B',
+            'street_nam': id_,
+            'trans_id': 'B' + off_street.OBJECTID.astype(str),
+            'geometry': off_street.geometry,
+            'street_typ': '',
+            'ewns_dir': '',
+            'class': '4',
+            'displayrou': 'OFF STREET',
+            'st_name': id_,
+            'br_oneway': 'N',
+            'contraflow': 'N',
+            'bike_ow': False,
+        }, crs=geoutils.WORKING_CRS)
+        offdf = geoutils.segmentize(offdf, max_length=max_segment_length)
+        split = offdf.si > 0
+        offdf.loc[split, 'trans_id'] = offdf.trans_id[split] + '-' + (offdf.si[split] + 1).astype(str)
+        offdf['actual'] = offdf.seg_length
+        offdf = offdf.drop(columns=['parent', 'si', 'seg_length'])
+        return PipelineResult(obj=enforce_schema(offdf))
 
 
 class StreetsBikeJoin(PipelineInterface):
     def __init__(self, stage_info):
         super().__init__(stage_info)
-        self.output = pd.DataFrame()
 
-    def merge_street(self, street_name):
-        street = self.streets.get_street(street_name)
-        bike_route = self.bike_routes.get_street(street_name)
-        assert not bike_route.empty
-        cumulative = geopandas.GeoDataFrame()
+    @staticmethod
+    def join(streets: geopandas.GeoDataFrame, bike_routes: geopandas.GeoDataFrame) -> geopandas.GeoDataFrame:
+        """
+        Attaches bike route attributes to every street segment that lies within 3 m of a bike route
+        with the same street name. All routes are matched in one spatial index query, with the name
+        equality applied as a join key. A segment matched by several routes appears once per route;
+        segments without a matching route are kept without route attributes.
+
+        Both layers must be in the same projected CRS.
+        """
         # street trans_id is a good unique key. we want to make sure we include segs without bike route info, too
-        # 150299 is missing
-        matched_segs = set([])
-        for ri, route in bike_route.iterrows():
-            matching = []
-            rgbuffer = route.geometry.buffer(3)
-            for si, seg in street.iterrows():
-                match = rgbuffer.contains(seg.geometry)
-                if match:
-                    matching.append(seg)
-                    matched_segs.add(seg.trans_id)
-            matched_frame = geopandas.GeoDataFrame(matching)
-            route_frame = pd.DataFrame([route.drop('geometry')])
-            if matched_frame.empty or route_frame.empty:
-                continue
-            m = matched_frame.merge(route_frame, left_on='street_nam', right_on='st_name')
-            m.crs = constants.CHICAGO_DATUM
-            cumulative = pd.concat([cumulative, m])
-        # now get segs without bike routes
-        rest_streets = street[~street.trans_id.isin(matched_segs)]
-        rest_streets.crs = constants.CHICAGO_DATUM
-        cumulative = pd.concat([cumulative, rest_streets])
-        if not cumulative.empty:
-            cumulative.crs = constants.CHICAGO_DATUM
-            self.output = pd.concat([self.output, cumulative])
+        buffers = bike_routes.geometry.buffer(3)
+        route_idx, street_idx = streets.sindex.query(buffers, predicate='contains')
+        same_name = streets['street_nam'].to_numpy()[street_idx] == bike_routes['st_name'].to_numpy()[route_idx]
+        route_idx = route_idx[same_name]
+        street_idx = street_idx[same_name]
+        matched = streets.iloc[street_idx].reset_index(drop=True)
+        routes = bike_routes.drop(columns='geometry').iloc[route_idx].reset_index(drop=True)
+        joined = pd.concat([matched, routes], axis=1)
+        unmatched = np.ones(len(streets), dtype=bool)
+        unmatched[street_idx] = False
+        return pd.concat([joined, streets[unmatched]], ignore_index=True)
 
     def run_stage(self) -> PipelineResult:
-        self.streets = BikeStreetsWrapper(self.get_dependency('streets_preprocess').get())
-        self.bike_routes = BikeStreetsWrapper(self.get_dependency('bike_routes_preprocess').get())
-        bike_streets = self.streets.get_streets() & self.bike_routes.get_streets()
-        other_streets = self.streets.get_streets() - self.bike_routes.get_streets()
-        pbar = tqdm.tqdm(bike_streets)
-        for streetname in pbar:
-            self.merge_street(streetname)
-        ostr = self.streets.layer
+        streets = BikeStreetsWrapper(self.get_dependency('streets_preprocess').get())
+        bike_routes = BikeStreetsWrapper(self.get_dependency('bike_routes_preprocess').get())
         rv = PipelineResult()
-        rv.obj = pd.concat([self.output, ostr[ostr.street_nam.isin(other_streets)]])
+        rv.obj = enforce_schema(self.join(streets.layer, bike_routes.layer))
         return rv
 
 
-class BikeStreetsOffJoin(PipelineInterface):
-    def __init__(self, stage_info):
-        super().__init__(stage_info)
-        self.rv = PipelineResult()
-        self.output = self.rv.obj
-
-    @staticmethod
-    def suitability(x):
-        """
-        Suitability index
-
-        0 - do not display
-        1 - bikes prohibited
-        2 - not recommended
-        3 - caution
-        4 - probably light traffic, no specific infra
-        5 - bike lane
-        6 - greenway, buffered
-        7 - protected
-        8 - off-street trail
-        :param x:
-        :return:
-        """
-        if x.status != 'N':
-            return 0
-        cmap = {
+class SuitabilityRules:
+    """
+    Table-driven suitability index and routing weight, evaluated column-wise.
+
+    Suitability index
+
+    0 - do not display
+    1 - bikes prohibited
+    2 - not recommended
+    3 - caution
+    4 - probably light traffic, no specific infra
+    5 - bike lane
+    6 - greenway, buffered
+    7 - protected
+    8 - off-street trail
+
+    Rules are applied in order, first match wins:
+    - status not in status_allowed: 0
+    - class_map by class
+    - route_map by displayrou, unless the class is listed for that route in route_excluded_classes
+    - class_fallback by class
+    - default
+
+    weight = actual * multipliers[suitability], or prohibited_weight if there is no multiplier.
+
+    DEFAULTS is the only full table; the suitability_rules stage parameter overrides single keys,
+    and single entries of the tables (class_map, multipliers, ...).
+    """
+    DEFAULTS = {
+        'status_allowed': ['N'],
+        'class_map': {
             'RIV': 0,
             'S': 0,
             '99': 0,
             '5': 0,
-            'E': 4, # try this instead
+            'E': 4,
             '1': 1,
             '9': 1,
-        }
-        # 2, 3, 4, 7  might have bike infra
-        rv = cmap.get(x['class'])
-        if rv is not None:
-            return rv
-        dr = x.displayrou
-        rmap = {
+        },
+        'route_map': {
             'BIKE LANE': 5,
             'NEIGHBORHOOD GREENWAY': 6,
             'BUFFERED BIKE LANE': 6,
             'PROTECTED BIKE LANE': 7,
-            'OFF STREET': 8, # this is fictionally postprocessed
-        }
-        rv = rmap.get(dr)
-        if rv is not None:
-            if rv == 5 and x['class'] == '2':
-                # don't allow bike lane optimization on class 2
-                pass
-            else:
-                return rv
-        if x['class'] == '4':
-            return 4
-        if x['class'] == '3':
-            return 3
-        if x['class'] == '2':
-            return 2
-        if x['class'] == '7':
-            # consider changing this to 1
-            return 1
-        # shouldn't get here
-        return -1
+            'OFF STREET': 8,
+        },
+        # don't allow bike lane optimization on class 2
+        'route_excluded_classes': {
+            'BIKE LANE': ['2'],
+        },
+        'class_fallback': {
+            '4': 4,
+            '3': 3,
+            '2': 2,
+            '7': 1,
+        },
+        'default': -1,
+        'multipliers': {
+            '2': 5.0,
+            '3': 2.0,
+            '4': 0.9,
+            '5': 1,
+            '6': 0.75,
+            '7': 0.6,
+            '8': 0.5,
+        },
+        'prohibited_weight': 1000000000,
+    }
+    MISSING = -9999
+
+    def __init__(self, rules: dict = None):
+        self.rules = self.merge(self.DEFAULTS, rules)
+
+    @staticmethod
+    def merge(defaults: dict, overrides: dict = None) -> dict:
+        """
+        :return: defaults with overrides applied, table entries one by one
+        """
+        merged = dict(defaults)
+        for k, v in (overrides or {}).items():
+            merged[k] = {**defaults[k], **v} if isinstance(defaults.get(k), dict) and isinstance(v, dict) else v
+        return merged
+
+    @staticmethod
+    def lookup(values, mapping: dict, default):
+        """
+        Maps values through a dict using categorical codes; code -1 (no match) picks the default.
+        """
+        cat = pd.Categorical(values, categories=list(mapping.keys()))
+        table = np.append(np.asarray(list(mapping.values())), default)
+        return table[cat.codes]
+
+    def suitability(self, df: pd.DataFrame) -> np.ndarray:
+        r = self.rules
+        cls = df['class'].astype(str).to_numpy()
+        route = df['displayrou'].astype(str).to_numpy()
+        status_ok = df['status'].isin(r['status_allowed']).to_numpy()
+        class_value = self.lookup(cls, r['class_map'], self.MISSING)
+        route_value = self.lookup(route, r['route_map'], self.MISSING)
+        excluded = np.zeros(len(df), dtype=bool)
+        for route_name, classes in r['route_excluded_classes'].items():
+            excluded |= (route == route_name) & np.isin(cls, classes)
+        fallback = self.lookup(cls, r['class_fallback'], r['default'])
+        return np.select(
+            [~status_ok, class_value != self.MISSING, (route_value != self.MISSING) & ~excluded],
+            [0, class_value, route_value],
+            default=fallback)
+
+    def weight(self, actual, suitability, multipliers: dict = None) -> np.ndarray:
+        """
+        :param multipliers: Multipliers of a weight profile, overriding single entries of the rules' multipliers;
+                            0 prohibits a suitability
+        """
+        multipliers = {**self.rules['multipliers'], **(multipliers or {})}
+        multipliers = {int(k): float(v) for k, v in multipliers.items()}
+        mult = self.lookup(np.asarray(suitability), multipliers, 0.0)
+        return np.where(mult == 0, float(self.rules['prohibited_weight']), mult * np.asarray(actual))
+
+
+class BikeStreetsOffJoin(PipelineInterface):
+    def __init__(self, stage_info):
+        super().__init__(stage_info)
+        self.rv = PipelineResult()
+        self.output = self.rv.obj
+        self.rules = SuitabilityRules(stage_info.get('parameters', {}).get('suitability_rules'))
 
     def normalize(self):
-        # incompletely working on processing everything in consistent coord systems
-        # if not self.output:
-        #    return None
         assert not self.output.empty
-        # merged = pd.concat(self.output)
-        self.output.crs = constants.CHICAGO_DATUM
+        self.output.crs = geoutils.WORKING_CRS
         # why is this needed?
         self.output = self.output[~self.output.geometry.isnull()]
-        self.output['actual'] = self.output.apply(lambda x: x.geometry.length, axis=1)
-        self.output['suitability'] = self.output.apply(self.suitability, axis=1)
-
-        suitability_multipliers = {
-            2: 5.0,
-            3: 2.0,
-            4: 0.9,
-            5: 1,
-            6: 0.75,
-            7: 0.6,
-            8: 0.5,
-        }
-
-        def weightfn(attrs):
-            weight = attrs['actual']
-            mult = suitability_multipliers.get(attrs['suitability'], 0)
-            # print(f'Path weight: {weight} m{mult} E{e0} {e1} {raw}')
-            if mult == 0:
-                return 1000000000
-            return mult * weight
-
-        self.output['weight'] = self.output.apply(weightfn, axis=1)
-        # merged.crs = constants.CHICAGO_DATUM
-        # return merged.to_crs(epsg=4326)
-        return self.output.to_crs(epsg=4326)
+        self.output['actual'] = self.output.geometry.length
+        self.output['suitability'] = self.rules.suitability(self.output)
+        self.output['weight'] = self.rules.weight(self.output['actual'], self.output['suitability'])
+        return enforce_schema(self.output)
 
     def run_stage(self) -> PipelineResult:
         # Now add in off-street routes using the column format above
@@ -1,30 +1,116 @@
 #!/usr/bin/env python3
 
+import json
+import os
 import zipfile
+from pathlib import Path
+
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
 
+import geoutils
 from pipeline_interface import PipelineInterface, PipelineResult
 from constants import datasets_path
 
 
 OSM_SOURCE = datasets_path() / 'osm' / 'illinois-latest-free.shp.zip'
+OSM_TILES = datasets_path() / 'osm' / 'tiles'
 
 # gis_osm_roads_free_1
 
 
+class OsmTileStore:
+    """
+    One-time ingest of each shapefile layer in the Geofabrik zip into GeoParquet tiles on a
+    regular lon/lat grid, so later reads only parse the tiles intersecting a bbox.
+
+    Layout: <root>/<source key>/<layer>/<tx>_<ty>-<chunk>.parquet plus index.json, which records
+    the actual feature extent of every file. Features are assigned to the tile containing the
+    center of their bounds; the recorded extents cover features that spill over tile edges.
+    The source key includes the zip size and mtime, so a new download is ingested again.
+    """
+    TILE_SIZE = 0.25
+    CHUNK = 250000
+
+    def __init__(self, source=OSM_SOURCE, root=OSM_TILES):
+        self.source = Path(source)
+        st = os.stat(self.source)
+        self.root = Path(root) / f'{self.source.stem}-{st.st_size}-{int(st.st_mtime)}'
+
+    def layers(self):
+        with zipfile.ZipFile(self.source) as zf:
+            return [x.filename[:-4] for x in zf.infolist() if x.filename.endswith('.shp')]
+
+    def layer_dir(self, layer) -> Path:
+        return self.root / layer
+
+    def ingest_layer(self, layer):
+        assert layer in self.layers(), f'{layer} not in {self.source}'
+        print(f'Ingesting {layer} from {self.source} into tiles')
+        outdir = self.layer_dir(layer)
+        os.makedirs(outdir, exist_ok=True)
+        url = f'zip://{self.source}!{layer}.shp'
+        total = pyogrio.read_info(url)['features']
+        index = {}
+        for chunk, start in enumerate(range(0, total, self.CHUNK)):
+            gdf = gpd.read_file(url, engine='pyogrio', use_arrow=True, skip_features=start, max_features=self.CHUNK)
+            bounds = gdf.bounds.to_numpy()
+            tx = np.floor((bounds[:, 0] + bounds[:, 2]) / 2 / self.TILE_SIZE).astype(int)
+            ty = np.floor((bounds[:, 1] + bounds[:, 3]) / 2 / self.TILE_SIZE).astype(int)
+            for (x, y), rows in pd.Series(np.arange(len(gdf))).groupby([tx, ty]):
+                filename = f'{x}_{y}-{chunk}.parquet'
+                tile = gdf.iloc[rows.to_numpy()]
+                tile.to_parquet(outdir / filename, index=False)
+                index[filename] = list(tile.total_bounds)
+        with open(outdir / 'index.json', 'w') as fh:
+            json.dump({'tile_size': self.TILE_SIZE, 'files': index}, fh)
+
+    def read(self, layer, bbox=None) -> gpd.GeoDataFrame:
+        """
+        :param bbox: Optional (minx, miny, maxx, maxy) in EPSG:4326; only intersecting features are returned
+        """
+        index_file = self.layer_dir(layer) / 'index.json'
+        if not index_file.exists():
+            self.ingest_layer(layer)
+        with open(index_file) as fh:
+            index = json.load(fh)['files']
+        files = list(index.keys())
+        if bbox is not None:
+            box = shapely.box(*bbox)
+            files = [f for f in files if box.intersects(shapely.box(*index[f]))]
+        print(f'Reading {len(files)} of {len(index)} tiles for {layer}')
+        if not files:
+            return gpd.GeoDataFrame(geometry=[], crs=4326)
+        gdf = pd.concat([gpd.read_parquet(self.layer_dir(layer) / f) for f in files], ignore_index=True)
+        if bbox is not None:
+            minx, miny, maxx, maxy = bbox
+            gdf = gdf.cx[minx:maxx, miny:maxy]
+        return gdf
+
+
 class OsmExtractor(PipelineInterface):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.source = zipfile.ZipFile(OSM_SOURCE)
-        self.shapefiles = [x for x in self.source.infolist() if x.filename.endswith('.shp')]
+
+    def get_bbox(self):
+        params = self.stage_info['parameters']
+        boundary = params.get('boundary')
+        if boundary:
+            boundary_gdf = self.get_dependency(boundary).get()
+            return tuple(boundary_gdf.to_crs(4326).total_bounds)
+        bbox = params.get('bbox')
+        if bbox:
+            return tuple(bbox)
+        return None
 
     def run_stage(self) -> PipelineResult:
         rv = PipelineResult()
-        filename = self.stage_info['parameters']['filename'] + '.shp'
-        print(f'check for {filename}')
-        assert filename in set([x.filename for x in self.shapefiles])
-        zipfile_url = f'zip://{OSM_SOURCE}!{filename}'
-        rv.obj = gpd.read_file(zipfile_url)
+        layer = self.stage_info['parameters']['filename']
+        print(f'check for {layer}')
+        rv.obj = OsmTileStore().read(layer, self.get_bbox())
         return rv
 
 
@@ -36,5 +122,6 @@ class OsmPreprocess(PipelineInterface):
         rv = PipelineResult()
         roads = self.get_dependency("osm_roads_fetch").get()
         city_boundary = self.get_dependency("city_boundary_fetch").get()
-        rv.obj = roads.clip(city_boundary.envelope)
+        clipper = geoutils.BoundaryClipper.for_boundaries(city_boundary, mode='envelope', crs=roads.crs)
+        rv.obj = clipper.clip(roads)
         return rv
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""
+Streaming ingestion of a local .osm.pbf extract.
+
+Unlike the Geofabrik shapefile zip, the pbf keeps every tag. Ways are filtered by
+tag while the file is parsed, their geometries are built in vectorized batches
+and written as GeoParquet parts, so memory stays bounded by the batch size and
+the node location index rather than the size of the state.
+
+Tag filter patterns (stage parameter "tags"):
+- highway=*        any value of highway
+- bicycle=designated
+- cycleway:*       any key starting with cycleway: (cycleway:left, cycleway:right:lane, ...)
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import osmium
+import pandas as pd
+import shapely
+
+from osmfetcher import OsmExtractor
+from pipeline_interface import PipelineResult
+from constants import datasets_path
+
+
+OSM_PBF_DIR = datasets_path() / 'osm'
+
+
+class TagFilter:
+    def __init__(self, patterns):
+        self.any_value = set()
+        self.values = {}
+        self.prefixes = []
+        for p in patterns:
+            k, _, v = p.partition('=')
+            if k.endswith(':*') and not v:
+                self.prefixes.append(k[:-1])
+            elif not v or v == '*':
+                self.any_value.add(k)
+            else:
+                self.values.setdefault(k, set()).add(v)
+
+    def keys(self):
+        return sorted(self.any_value | set(self.values.keys()))
+
+    def matches(self, tags) -> bool:
+        for tag in tags:
+            k = tag.k
+            if k in self.any_value:
+                return True
+            vals = self.values.get(k)
+            if vals and tag.v in vals:
+                return True
+            for prefix in self.prefixes:
+                if k.startswith(prefix):
+                    return True
+        return False
+
+
+class WayCollector(osmium.SimpleHandler):
+    def __init__(self, tag_filter: TagFilter, columns, outdir: Path, batch_size=100000, bbox=None):
+        super().__init__()
+        self.tag_filter = tag_filter
+        self.columns = columns
+        self.outdir = outdir
+        self.batch_size = batch_size
+        self.bbox = shapely.box(*bbox) if bbox else None
+        self.parts = 0
+        self.written = 0
+        self.reset()
+
+    def reset(self):
+        self.ids = []
+        self.tags = []
+        self.coords = []
+        self.counts = []
+
+    def way(self, w):
+        if not self.tag_filter.matches(w.tags):
+            return
+        coords = []
+        for n in w.nodes:
+            if not n.location.valid():
+                return
+            coords.append((n.lon, n.lat))
+        if len(coords) < 2:
+            return
+        self.ids.append(w.id)
+        self.tags.append({t.k: t.v for t in w.tags})
+        self.coords.extend(coords)
+        self.counts.append(len(coords))
+        if len(self.ids) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.ids:
+            return
+        indices = np.repeat(np.arange(len(self.counts)), self.counts)
+        geoms = shapely.linestrings(np.asarray(self.coords), indices=indices)
+        df = pd.DataFrame({'osm_id': np.asarray(self.ids, dtype=np.int64)})
+        for c in self.columns:
+            df[c] = [t.get(c) for t in self.tags]
+        df['tags'] = [json.dumps(t) for t in self.tags]
+        gdf = gpd.GeoDataFrame(df, geometry=geoms, crs=4326)
+        if self.bbox is not None:
+            gdf = gdf[shapely.intersects(gdf.geometry.values, self.bbox)]
+        gdf.to_parquet(self.outdir / f'part-{self.parts}.parquet', index=False)
+        self.parts += 1
+        self.written += len(gdf)
+        self.reset()
+
+
+def ingest(source, tags, columns=None, bbox=None, location_index='flex_mem') -> Path:
+    """
+    Streams the ways matching tags out of source into a directory of GeoParquet parts.
+    The output is reused for the same source file, tag filter, columns and bbox.
+
+    :return: Output directory
+    """
+    source = Path(source)
+    tag_filter = TagFilter(tags)
+    if columns is None:
+        columns = tag_filter.keys()
+    st = os.stat(source)
+    key = json.dumps([source.name, st.st_size, int(st.st_mtime), sorted(tags), columns, bbox])
+    outdir = source.parent / 'pbf' / hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+    done = outdir / 'done.json'
+    if done.exists():
+        return outdir
+    os.makedirs(outdir, exist_ok=True)
+    print(f'Streaming ways matching {tags} from {source}')
+    collector = WayCollector(tag_filter, columns, outdir, bbox=bbox)
+    collector.apply_file(str(source), locations=True, idx=location_index)
+    collector.flush()
+    with open(done, 'w') as fh:
+        json.dump({'key': json.loads(key), 'parts': collector.parts, 'ways': collector.written}, fh)
+    print(f'Wrote {collector.written} ways in {collector.parts} parts to {outdir}')
+    return outdir
+
+
+class OsmPbfExtractor(OsmExtractor):
+    def run_stage(self) -> PipelineResult:
+        rv = PipelineResult()
+        params = self.stage_info['parameters']
+        bbox = self.get_bbox()
+        outdir = ingest(OSM_PBF_DIR / params['filename'], params['tags'], params.get('columns'),
+                        list(bbox) if bbox else None, params.get('location_index', 'flex_mem'))
+        parts = sorted(outdir.glob('part-*.parquet'))
+        if not parts:
+            rv.obj = gpd.GeoDataFrame(geometry=[], crs=4326)
+            return rv
+        rv.obj = pd.concat([gpd.read_parquet(p) for p in parts], ignore_index=True)
+        return rv
@@ -2,11 +2,39 @@ from abc import ABC, abstractmethod
 from dataclasses import dataclass
 
 import geopandas as gpd
+from pyarrow import ArrowException
+import pyarrow.parquet as pq
+import pandas as pd
+import json
 import os
 import uuid
 import datetime
 import pickle
 
+PARQUET_MAGIC = b'PAR1'
+
+
+def plain_dtypes(df):
+    """
+    Categorical columns as plain values, for file drivers without categorical support.
+    """
+    categorical = [c for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)]
+    if not categorical:
+        return df
+    return df.astype({c: object for c in categorical})
+
+def read_parquet_frame(filename):
+    """
+    Reads a cached frame; frames without an active geometry column (an empty GeoDataFrame,
+    a plain DataFrame) have no GeoParquet primary column and are read with pandas.
+    """
+    geo = (pq.read_schema(filename).metadata or {}).get(b'geo')
+    if geo and json.loads(geo).get('primary_column'):
+        return gpd.read_parquet(filename)
+    df = pd.read_parquet(filename)
+    return gpd.GeoDataFrame(df) if geo else df
+
+
 @dataclass
 class PipelineResult:
     obj = None
@@ -75,6 +103,10 @@ class PipelineResult:
         if self.obj is None:
             assert self.valid()
             if self.objtype == 'geopandas.GeoDataFrame':
+                with open(self.filename, 'rb') as fh:
+                    magic = fh.read(len(PARQUET_MAGIC))
+                if magic == PARQUET_MAGIC:
+                    return read_parquet_frame(self.filename)
                 return gpd.read_file(self.filename)
             elif self.objtype == '$picklefile':
                 with open(self.filename, 'rb') as fh:
@@ -102,7 +134,13 @@ class PipelineResult:
         filename = str(uuid.uuid1())
         filepath = os.path.join(dir_, filename)
         if self.objtype == 'geopandas.GeoDataFrame':
-            self.obj.to_file(filepath, driver='GeoJSON')
+            # GeoParquet keeps dtypes (categoricals, booleans) across the cache; GeoJSON is the fallback
+            # for frames parquet can't store, eg mixed-type object columns
+            try:
+                self.obj.to_parquet(filepath)
+            except (ValueError, TypeError, ArrowException) as e:
+                print(f'Falling back to GeoJSON serialization: {e}')
+                plain_dtypes(self.obj).to_file(filepath, driver='GeoJSON')
         elif self.objtype == '$bytesfile':
             with open(filepath, 'wb') as fh:
                 fh.write(self.obj)
@@ -124,6 +162,7 @@ class PipelineInterface(ABC):
         self.stage_info: dict = stage_info
         self.depend_results = {}
         self.dependencies = None
+        self.stages = {}
 
     @abstractmethod
     def run_stage(self) -> PipelineResult:
@@ -135,6 +174,15 @@ class PipelineInterface(ABC):
     def set_dependencies(self, dependencies):
         self.dependencies = dependencies
 
+    def set_stages(self, stages):
+        """
+        :param stages: Configuration of every stage by name, for parameters shared with another stage
+        """
+        self.stages = stages
+
+    def stage_parameters(self, name) -> dict:
+        return self.stages.get(name, {}).get('parameters', {})
+
     def get_dependency(self, name):
         # need to assert that dependency is actually in config
         if name not in self.depend_results:
@@ -11,7 +11,7 @@ from typing import List
 
 from peewee import SqliteDatabase, Model, CharField, DateTimeField, fn
 
-from pipeline_interface import PipelineResult
+from pipeline_interface import PipelineResult, plain_dtypes
 from constants import datasets_path, pipeline_cache_path, shapefile_path
 
 db = SqliteDatabase(datasets_path() / 'pipeline.sqlite3')
@@ -90,6 +90,7 @@ class WorkContext:
             inst = getattr(module, oc)(stage_info)
             inst.set_results(self.results)
             inst.set_dependencies(self.dependencies)
+            inst.set_stages(self.stages)
             # get stage info
             module_updated = os.stat(module.__file__).st_mtime
             previous_runs = StageExecution().select().where(StageExecution.name == self.stage_name).order_by(StageExecution.executed.desc())
@@ -220,7 +221,7 @@ class Runner:
         if self.workflow.get('destination_type') != 'shapefile':
             raise NotImplementedError('Other workflow destination types not implemented')
         fs = self.workflow['final']
-        self.results[fs].get().to_file(os.path.join(shapefile_path() / f'{fs}.shp'))
+        plain_dtypes(self.results[fs].get()).to_file(os.path.join(shapefile_path() / f'{fs}.shp'))
 
 
 def db_initialize():
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+"""
+Local routing service on a warm bike network.
+
+Loads the latest successful network_analyze output (or bikestreets_off_join if
+there is none) from the pipeline cache once, compiles it through the graph store,
+and answers queries from the in-memory graph:
+
+- /route?from=lon,lat&to=lon,lat: cost, length and segments of the best route
+- /isochrone?at=lon,lat&cost=...: segments reachable within a route cost
+- /nearest?at=lon,lat: the segment a point snaps to
+- /status: which pipeline execution is loaded
+
+Responses are JSON with GeoJSON geometries in EPSG:4326. Requests are served on
+threads; each request uses the network that was loaded when it started. A poll
+thread checks the pipeline database and swaps in a newer execution once it is
+loaded, so the service keeps answering during a reload.
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from pyproj import Transformer
+from scipy.sparse.csgraph import dijkstra
+
+import columnar
+import geoutils
+import routing
+from graphexplore import NxFinder2
+from pipeline_interface import PipelineResult, plain_dtypes
+from pipelinerunner import PIPELINE_STAGE_FILES, StageExecution, db
+
+STAGES = ['network_analyze', 'bikestreets_off_join']
+SEGMENT_COLUMNS = ['trans_id', 'street_nam', 'suitability', 'weight', 'actual']
+
+
+def latest_execution(stages=STAGES) -> StageExecution | None:
+    """
+    :return: Latest successful execution of the first stage in stages that has one
+    """
+    with db.connection_context():
+        for name in stages:
+            latest = (StageExecution.select()
+                      .where((StageExecution.name == name) & (StageExecution.status == 'ok'))
+                      .order_by(StageExecution.executed.desc())
+                      .first())
+            if latest is not None:
+                return latest
+    return None
+
+
+class WarmNetwork:
+    """
+    A network layer compiled for routing, with arbitrary points snapped on query.
+    Not modified after construction, so threads share it without locking.
+    """
+    def __init__(self, network_gdf: gpd.GeoDataFrame, graph_key=None, snap_distance=100.0, label=None):
+        """
+        :param snap_distance: Meters from a query point to the network
+        :param label: Where the network came from, for status
+        """
+        empty = gpd.GeoDataFrame(geometry=[], crs=geoutils.WORKING_CRS)
+        self.finder = NxFinder2(network_gdf, empty, graph_key=graph_key, contract=False)
+        self.graph = self.finder.base_graph
+        self.edges = self.finder.edges
+        self.query = self.finder.query
+        self.snap_distance = snap_distance
+        # built once per loaded network; queries only search it
+        self.tree = shapely.STRtree(self.edges.geometry.values)
+        self.label = label
+        self.loaded = time.time()
+        self.to_working = Transformer.from_crs(4326, geoutils.WORKING_CRS, always_xy=True)
+
+    @classmethod
+    def from_execution(cls, execution: StageExecution, snap_distance=100.0):
+        path = os.path.join(PIPELINE_STAGE_FILES, execution.filename)
+        gdf = PipelineResult.from_cached(path, 'geopandas.GeoDataFrame').get()
+        graph_key = routing.GraphStore.key(columnar.content_hash(path), NxFinder2.MAX)
+        return cls(gdf, graph_key, snap_distance, {
+            'stage': execution.name,
+            'executed': str(execution.executed),
+            'filename': execution.filename,
+        })
+
+    def snap(self, lon, lat):
+        """
+        :return: (edge, node, distance in meters), edge and node -1 if nothing is within snap_distance
+        """
+        point = gpd.points_from_xy(*self.to_working.transform([lon], [lat]))
+        edge, node = self.graph.snap(self.edges.geometry.values, point, self.snap_distance, tree=self.tree)
+        if edge[0] < 0:
+            return -1, -1, None
+        return int(edge[0]), int(node[0]), float(self.edges.geometry.values[edge[0]].distance(point[0]))
+
+    def features(self, rows: gpd.GeoDataFrame, columns=SEGMENT_COLUMNS) -> dict:
+        columns = [c for c in columns if c in rows.columns]
+        return json.loads(plain_dtypes(rows[columns + ['geometry']]).to_crs(4326).to_json(drop_id=True))
+
+    def status(self) -> dict:
+        return {**(self.label or {}), **self.graph.summary(), 'loaded': time.ctime(self.loaded)}
+
+    def nearest(self, lon, lat) -> dict:
+        edge, node, distance = self.snap(lon, lat)
+        if edge < 0:
+            raise LookupError(f'No segment within {self.snap_distance} m')
+        return {'distance': distance, 'node': node, 'segment': self.features(self.edges.iloc[[edge]])}
+
+    def route(self, start, end) -> dict:
+        _, origin, _ = self.snap(*start)
+        _, destination, _ = self.snap(*end)
+        if origin < 0 or destination < 0:
+            raise LookupError(f'No segment within {self.snap_distance} m')
+        r = self.query.route(origin, destination)
+        if r is None:
+            raise LookupError('No route')
+        return {
+            'cost': r.cost,
+            'length': float(r.edges['actual'].astype(float).sum()) if 'actual' in r.edges else None,
+            'elapsed_ms': r.elapsed_ms,
+            'segments': self.features(r.edges),
+        }
+
+    def isochrone(self, at, cost) -> dict:
+        """
+        Segments with both end nodes reachable from the point within cost, with the larger of their end node
+        costs.
+        """
+        started = time.perf_counter()
+        _, origin, _ = self.snap(*at)
+        if origin < 0:
+            raise LookupError(f'No segment within {self.snap_distance} m')
+        dist = dijkstra(self.graph.csr, directed=True, indices=origin, limit=cost)
+        reached = np.maximum(dist[self.graph.edge_u], dist[self.graph.edge_v])
+        within = np.flatnonzero(reached <= cost)
+        rows = self.edges.iloc[within].assign(cost=reached[within])
+        return {
+            'nodes': int(np.count_nonzero(np.isfinite(dist))),
+            'elapsed_ms': (time.perf_counter() - started) * 1000,
+            'segments': self.features(rows, ['trans_id', 'street_nam', 'cost']),
+        }
+
+
+class RouteServer(ThreadingHTTPServer):
+    """
+    Serves a WarmNetwork, replaced when the pipeline has a newer execution.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, stages=STAGES, snap_distance=100.0, poll=30.0):
+        """
+        :param poll: Seconds between checks for a newer execution, 0 to never reload
+        """
+        self.stages = stages
+        self.snap_distance = snap_distance
+        self.poll = poll
+        self.reload_lock = threading.Lock()
+        self.execution_id = None
+        self.network: WarmNetwork | None = None
+        if not self.reload():
+            raise FileNotFoundError(f'No successful execution of {" or ".join(stages)}')
+        super().__init__(('127.0.0.1', port), RouteHandler)
+        if poll:
+            threading.Thread(target=self.poll_forever, daemon=True).start()
+
+    def reload(self) -> bool:
+        """
+        Loads the latest execution if it is not the one being served.
+
+        :return: Whether a network is being served
+        """
+        with self.reload_lock:
+            latest = latest_execution(self.stages)
+            if latest is not None and latest.id != self.execution_id:
+                print(f'Loading {latest.name} from run at {latest.executed}')
+                # requests keep using the old network until the new one is assigned
+                self.network = WarmNetwork.from_execution(latest, self.snap_distance)
+                self.execution_id = latest.id
+            return self.network is not None
+
+    def poll_forever(self):
+        while True:
+            time.sleep(self.poll)
+            try:
+                self.reload()
+            except Exception as e:
+                print(f'Reload failed, still serving the previous network: {e}')
+
+
+def lonlat(value):
+    lon, lat = (float(v) for v in value.split(','))
+    return lon, lat
+
+
+class RouteHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server: RouteServer = self.server
+        network = server.network
+        url = urlparse(self.path)
+        args = {k: v[0] for k, v in parse_qs(url.query).items()}
+        try:
+            if url.path == '/route':
+                body = network.route(lonlat(args['from']), lonlat(args['to']))
+            elif url.path == '/isochrone':
+                body = network.isochrone(lonlat(args['at']), float(args['cost']))
+            elif url.path == '/nearest':
+                body = network.nearest(*lonlat(args['at']))
+            elif url.path == '/status':
+                body = network.status()
+            else:
+                self.send_error(404)
+                return
+        except (KeyError, ValueError) as e:
+            self.send_json(400, {'error': f'Bad query: {e}'})
+            return
+        except LookupError as e:
+            self.send_json(404, {'error': str(e)})
+            return
+        self.send_json(200, body)
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='RouteService',
+        description='Serve route, isochrone and nearest segment queries on the latest pipeline network',
+    )
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--stage', action='append', help='Stage to load, in order of preference')
+    parser.add_argument('--snap-distance', type=float, default=100.0)
+    parser.add_argument('--poll', type=float, default=30.0)
+    args = parser.parse_args()
+    server = RouteServer(args.port, args.stage or STAGES, args.snap_distance, args.poll)
+    print(f'Serving {server.network.label["stage"]} on port {args.port}')
+    server.serve_forever()
@@ -0,0 +1,836 @@
+#!/usr/bin/env python3
+
+"""
+Compiled routing graph for the bike network.
+
+The network layer is compiled once into a CSR adjacency with float weights, and
+routes are found with one single-source Dijkstra per origin
+(scipy.sparse.csgraph), which gives predecessor trees for every destination
+at once.
+
+Nodes are the exact endpoint coordinates of the segments, as in the momepy primal
+graph. Each segment is an arc from its first to its last point, plus the reverse
+arc unless the segment is one way for bikes (bike_ow). Among parallel arcs
+between the same nodes only the cheapest is kept.
+
+Compiled graphs are saved as plain arrays (GraphStore), so repeated analyses of
+the same network load them memory-mapped instead of compiling again.
+
+OriginSampler estimates the route counts from a growing seeded sample of origins
+instead of routing all pairs, stopping once the estimate is precise enough.
+"""
+
+import hashlib
+import heapq
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+from scipy.stats import norm
+
+from constants import pipeline_cache_path
+
+# predecessor value for the origin and for unreachable nodes
+NO_PREDECESSOR = -9999
+
+
+class CompiledGraph:
+    def __init__(self, coords, arc_u, arc_v, arc_weight, arc_edge, edge_u, edge_v, trans_id, strong=None, weak=None):
+        """
+        :param coords: (n, 2) node coordinates
+        :param arc_u: Arc start nodes, sorted by (arc_u, arc_v) with no duplicate pairs
+        :param arc_v: Arc end nodes
+        :param arc_weight: Arc weights
+        :param arc_edge: Network row (edge) each arc comes from
+        :param edge_u: First node of each edge
+        :param edge_v: Last node of each edge
+        :param trans_id: trans_id of each edge
+        :param strong: Strongly connected component label of each node, computed if not given
+        :param weak: Weakly connected component label of each node, computed if not given
+        """
+        self.coords = coords
+        self.arc_u = arc_u
+        self.arc_v = arc_v
+        self.arc_weight = arc_weight
+        self.arc_edge = arc_edge
+        self.edge_u = edge_u
+        self.edge_v = edge_v
+        self.trans_id = trans_id
+        n = self.node_count
+        self.arc_keys = arc_u.astype(np.int64) * n + arc_v
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(arc_u, minlength=n), out=indptr[1:])
+        # built from the raw arrays so zero weight arcs are kept as explicit entries
+        self.csr = csr_matrix((arc_weight, arc_v, indptr), shape=(n, n))
+        if strong is None:
+            _, strong = connected_components(self.csr, directed=True, connection='strong')
+        if weak is None:
+            _, weak = connected_components(self.csr, directed=True, connection='weak')
+        self.strong = strong
+        self.weak = weak
+
+    @property
+    def node_count(self):
+        return len(self.coords)
+
+    @property
+    def edge_count(self):
+        return len(self.trans_id)
+
+    @classmethod
+    def from_gdf(cls, gdf: gpd.GeoDataFrame, weight='weight', oneway='bike_ow', max_weight=None):
+        """
+        :param gdf: LineString network layer with trans_id, weight and oneway columns
+        :param max_weight: Edges weighted this much or more (or not at all) are prohibited and left out
+        """
+        geoms = gdf.geometry.values
+        coords, idx = shapely.get_coordinates(geoms, return_index=True)
+        counts = np.bincount(idx, minlength=len(gdf))
+        last = np.cumsum(counts) - 1
+        first = last - counts + 1
+        ends = np.concatenate([coords[first], coords[last]])
+        nodes, inverse = np.unique(ends, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        edge_u, edge_v = inverse[:len(gdf)], inverse[len(gdf):]
+
+        weights = gdf[weight].astype(float).to_numpy()
+        return cls.from_edges(nodes, edge_u, edge_v, weights, cls.twoway(gdf, oneway),
+                              gdf['trans_id'].to_numpy().astype(str), max_weight)
+
+    @staticmethod
+    def twoway(gdf, oneway='bike_ow') -> np.ndarray:
+        # same truthiness as momepy: only a false value adds the reverse direction
+        return ~gdf[oneway].map(bool).to_numpy(dtype=bool)
+
+    @classmethod
+    def from_edges(cls, coords, edge_u, edge_v, weights, twoway, trans_id, max_weight=None):
+        edges = np.arange(len(edge_u))
+        u = np.concatenate([edge_u, edge_v[twoway]])
+        v = np.concatenate([edge_v, edge_u[twoway]])
+        w = np.concatenate([weights, weights[twoway]])
+        e = np.concatenate([edges, edges[twoway]])
+        keep = (u != v) & ~np.isnan(w)
+        if max_weight is not None:
+            keep &= w < max_weight
+        u, v, w, e = u[keep], v[keep], w[keep], e[keep]
+
+        order = cls.cheapest_arcs(u, v, w, len(coords))
+        return cls(coords, u[order], v[order], w[order], e[order], edge_u, edge_v, trans_id)
+
+    def reweight(self, weights, twoway, max_weight=None) -> 'CompiledGraph':
+        """
+        Same nodes and edges with other edge weights.
+
+        :param weights: Weight of each edge
+        :param twoway: Whether each edge can be used in both directions
+        """
+        return CompiledGraph.from_edges(self.coords, self.edge_u, self.edge_v, np.asarray(weights, dtype=float),
+                                        twoway, self.trans_id, max_weight)
+
+    def routing_nodes(self, nodes) -> np.ndarray:
+        """
+        :param nodes: Node ids of the graph the points were snapped on, -1 for none
+        :return: Node ids in this graph
+        """
+        return np.asarray(nodes, dtype=np.int64)
+
+    @staticmethod
+    def cheapest_arcs(u, v, w, n) -> np.ndarray:
+        """
+        :return: Indices of the cheapest arc of each (u, v) pair, sorted by (u, v)
+        """
+        keys = np.asarray(u, dtype=np.int64) * n + v
+        order = np.lexsort((w, keys))
+        first_of_key = np.ones(len(order), dtype=bool)
+        first_of_key[1:] = keys[order][1:] != keys[order][:-1]
+        return order[first_of_key]
+
+    def summary(self) -> dict:
+        sizes = np.bincount(self.strong)
+        return {
+            'nodes': self.node_count,
+            'edges': self.edge_count,
+            'arcs': len(self.arc_u),
+            'strong_components': len(sizes),
+            'weak_components': int(self.weak.max()) + 1 if len(self.weak) else 0,
+            'largest_strong_component': int(sizes.max()) if len(sizes) else 0,
+        }
+
+    def main_component_edges(self) -> np.ndarray:
+        """
+        :return: Mask of the edges with both nodes in the largest strongly connected component
+        """
+        main = np.argmax(np.bincount(self.strong))
+        return (self.strong[self.edge_u] == main) & (self.strong[self.edge_v] == main)
+
+    def snap(self, edge_geoms, points, max_distance=20.0, edge_mask=None, tree: shapely.STRtree = None):
+        """
+        Snaps points to the nearest edge within max_distance (ties go to the lowest edge index)
+        and to the nearer endpoint node of that edge (ties go to the first node).
+
+        :param edge_geoms: Geometries of the edges, in edge order
+        :param points: Point geometries in the same CRS
+        :param edge_mask: Only snap to these edges
+        :param tree: STRtree of edge_geoms, for repeated snapping without edge_mask
+        :return: (edge index, node index) per point, -1 where nothing is within max_distance
+        """
+        points = np.asarray(points)
+        candidates = np.arange(len(edge_geoms)) if edge_mask is None else np.flatnonzero(edge_mask)
+        none = np.iinfo(np.int64).max
+        edge = np.full(len(points), none, dtype=np.int64)
+        node = np.full(len(points), -1, dtype=np.int64)
+        if tree is None or edge_mask is not None:
+            tree = shapely.STRtree(np.asarray(edge_geoms)[candidates])
+        inputs, edges = tree.query_nearest(points, max_distance=max_distance, all_matches=True)
+        np.minimum.at(edge, inputs, candidates[edges])
+        found = edge != none
+        edge[~found] = -1
+        e = edge[found]
+        xy = shapely.get_coordinates(points[found])
+        du = np.hypot(*(self.coords[self.edge_u[e]] - xy).T)
+        dv = np.hypot(*(self.coords[self.edge_v[e]] - xy).T)
+        node[found] = np.where(dv < du, self.edge_v[e], self.edge_u[e])
+        return edge, node
+
+    def arcs(self, u, v) -> np.ndarray:
+        """
+        :return: Arc index of each (u, v) pair; the arcs must exist
+        """
+        return np.searchsorted(self.arc_keys, np.asarray(u, dtype=np.int64) * self.node_count + v)
+
+    def shortest_path_trees(self, origins, chunk=64):
+        """
+        Single-source Dijkstra from each origin, chunk origins at a time.
+
+        :return: Iterator of (origins, distances, predecessors) per chunk
+        """
+        origins = np.asarray(origins)
+        for i in range(0, len(origins), chunk):
+            batch = origins[i:i + chunk]
+            dist, pred = dijkstra(self.csr, directed=True, indices=batch, return_predecessors=True)
+            yield batch, dist, pred
+
+    def path_nodes(self, pred_row, origin, dest) -> np.ndarray | None:
+        """
+        :return: Nodes from origin to dest, or None if dest is unreachable
+        """
+        nodes = [dest]
+        node = dest
+        while node != origin:
+            node = pred_row[node]
+            if node == NO_PREDECESSOR:
+                return None
+            nodes.append(node)
+        return np.asarray(nodes[::-1])
+
+    def path_edges(self, pred_row, origin, dest) -> np.ndarray | None:
+        """
+        :return: Edge (network row) indices from origin to dest, or None if dest is unreachable
+        """
+        nodes = self.path_nodes(pred_row, origin, dest)
+        if nodes is None:
+            return None
+        return self.arc_edges(self.arcs(nodes[:-1], nodes[1:]))[0]
+
+    def contract(self, terminals=None) -> 'ContractedGraph':
+        """
+        Contracts chains of pass-through nodes into single arcs with summed weights. A node passes
+        through if it has exactly two neighbors and either is two way to both or has one arc in
+        from one and one arc out to the other. Terminal nodes (eg snapped points) are always kept.
+
+        :param terminals: Base node ids to keep
+        """
+        n = self.node_count
+        indptr = self.csr.indptr
+        out_deg = np.diff(indptr)
+        in_deg = np.bincount(self.arc_v, minlength=n)
+        pairs = np.unique(np.sort(np.stack([self.arc_u, self.arc_v], axis=1), axis=1), axis=0)
+        neighbors = np.bincount(pairs.reshape(-1), minlength=n)
+        through = (neighbors == 2) & (((in_deg == 2) & (out_deg == 2)) | ((in_deg == 1) & (out_deg == 1)))
+        if terminals is not None:
+            through[np.asarray(terminals)] = False
+
+        arc_u, arc_v, arc_w, members, member_ptr = [], [], [], [], [0]
+        arc_v_all, weights = self.arc_v, self.arc_weight
+        for a in np.flatnonzero(~through[self.arc_u]):
+            prev, x = self.arc_u[a], arc_v_all[a]
+            chain = [a]
+            w = weights[a]
+            while through[x]:
+                lo, hi = indptr[x], indptr[x + 1]
+                nxt = lo if hi - lo == 1 or arc_v_all[lo] != prev else lo + 1
+                chain.append(nxt)
+                w += weights[nxt]
+                prev, x = x, arc_v_all[nxt]
+            arc_u.append(self.arc_u[a])
+            arc_v.append(x)
+            arc_w.append(w)
+            members.extend(chain)
+            member_ptr.append(len(members))
+
+        kept = np.flatnonzero(~through)
+        node_map = np.full(n, -1, dtype=np.int64)
+        node_map[kept] = np.arange(len(kept))
+        u = node_map[np.asarray(arc_u, dtype=np.int64)]
+        v = node_map[np.asarray(arc_v, dtype=np.int64)]
+        w = np.asarray(arc_w, dtype=float)
+        member_ptr = np.asarray(member_ptr, dtype=np.int64)
+        order = self.cheapest_arcs(u, v, w, len(kept))
+        order = order[u[order] != v[order]]
+        lengths = np.diff(member_ptr)[order]
+        starts = member_ptr[order]
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        new_members = np.asarray(members, dtype=np.int64)[np.repeat(starts, lengths) + offsets]
+        new_ptr = np.concatenate([[0], np.cumsum(lengths)])
+        return ContractedGraph(self, kept, u[order], v[order], w[order], new_ptr, new_members)
+
+    def arc_edges(self, arcs):
+        """
+        :return: (edges along the arcs in order, index into arcs of the arc each edge belongs to)
+        """
+        return self.arc_edge[arcs], np.arange(len(arcs))
+
+    @staticmethod
+    def tree_depths(parent) -> np.ndarray:
+        """
+        Depth of every node in a forest by pointer jumping.
+
+        :param parent: Parent of each node, roots (and unreachable nodes) point to themselves
+        """
+        anc = parent.copy()
+        depth = (parent != np.arange(len(parent))).astype(np.int64)
+        while True:
+            step = anc[anc]
+            if np.array_equal(step, anc):
+                return depth
+            depth = depth + depth[anc]
+            anc = step
+
+    def accumulate(self, pairs, positions=None, weights=None, chunk=64, groups=None):
+        """
+        Per edge route counts without materializing paths: the destination counts of each
+        origin's shortest path tree are summed up the tree, deepest level first, and every
+        tree arc adds its subtree total to its edge.
+
+        :param pairs: (origin node, destination node) pairs
+        :param positions: Route number of each pair, default 1..len(pairs)
+        :param weights: Number of routes each pair stands for, default 1
+        :param groups: Group (eg trans_id code) of each edge; if set, route counts per origin and group
+                       are returned as well
+        :return: (routes through each edge, max route number through each edge or -1,
+                  routes with no path, routes skipped without a search because the endpoints
+                  are in different weakly connected components),
+                  with groups also (origin nodes, groups, routes) of every origin and group with routes
+        """
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        positions = np.arange(1, len(pairs) + 1) if positions is None else np.asarray(positions)
+        weights = np.ones(len(pairs), dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+        connected = self.weak[pairs[:, 0]] == self.weak[pairs[:, 1]]
+        skipped = int(weights[~connected].sum())
+        pairs, positions, weights = pairs[connected], positions[connected], weights[connected]
+        n = self.node_count
+        counts = np.zeros(self.edge_count, dtype=np.int64)
+        maxpos = np.full(self.edge_count, -1, dtype=np.int64)
+        failed = 0
+        totals = []
+        group_count = int(groups.max()) + 1 if groups is not None and len(groups) else 1
+        origins, inverse = np.unique(pairs[:, 0], return_inverse=True)
+        for start in range(0, len(origins), chunk):
+            batch = origins[start:start + chunk]
+            _, pred = dijkstra(self.csr, directed=True, indices=batch, return_predecessors=True)
+            sel = (inverse >= start) & (inverse < start + len(batch))
+            flat_dest = (inverse[sel] - start) * n + pairs[sel, 1]
+
+            rows = np.repeat(np.arange(len(batch)) * n, n)
+            pred = pred.reshape(-1).astype(np.int64)
+            reached = pred != NO_PREDECESSOR
+            nodes = np.arange(len(pred))
+            parent = np.where(reached, pred + rows, nodes)
+            failed += int(weights[sel][~reached[flat_dest] & (flat_dest % n != pairs[sel, 0])].sum())
+
+            acc = np.zeros(len(pred), dtype=np.int64)
+            np.add.at(acc, flat_dest, weights[sel])
+            acc[~reached] = 0
+            best = np.full(len(pred), -1, dtype=np.int64)
+            np.maximum.at(best, flat_dest, positions[sel])
+            best[~reached] = -1
+
+            depth = self.tree_depths(parent)
+            order = np.argsort(depth, kind='stable')[::-1]
+            levels = np.flatnonzero(np.diff(depth[order])) + 1
+            for level in np.split(order, levels):
+                if depth[level[0]] == 0:
+                    break
+                level = level[(acc[level] > 0)]
+                np.add.at(acc, parent[level], acc[level])
+                np.maximum.at(best, parent[level], best[level])
+
+            used = np.flatnonzero(reached & (acc > 0))
+            edges, owner = self.arc_edges(self.arcs(pred[used], used % n))
+            np.add.at(counts, edges, acc[used][owner])
+            np.maximum.at(maxpos, edges, best[used][owner])
+            if groups is not None:
+                keys, slot = np.unique((used[owner] // n) * group_count + groups[edges], return_inverse=True)
+                routes = np.zeros(len(keys), dtype=np.int64)
+                np.add.at(routes, slot, acc[used][owner])
+                totals.append((batch[keys // group_count], keys % group_count, routes))
+        if groups is None:
+            return counts, maxpos, failed, skipped
+        totals = tuple(np.concatenate(t) for t in zip(*totals)) if totals else (np.zeros(0, dtype=np.int64),) * 3
+        return counts, maxpos, failed, skipped, totals
+
+    def route(self, pairs: Iterable[Tuple[int, int]]):
+        """
+        Routes (origin node, destination node) pairs, grouped by origin.
+
+        :return: Iterator of (position of the pair, edge indices or None if unreachable)
+        """
+        pairs = np.asarray(list(pairs), dtype=np.int64).reshape(-1, 2)
+        connected = self.weak[pairs[:, 0]] == self.weak[pairs[:, 1]]
+        for pos in np.flatnonzero(~connected):
+            yield pos, None
+        by_origin = np.flatnonzero(connected)
+        if not len(by_origin):
+            return
+        by_origin = by_origin[np.argsort(pairs[by_origin, 0], kind='stable')]
+        origins, starts = np.unique(pairs[by_origin, 0], return_index=True)
+        bounds = np.append(starts, len(by_origin))
+        for batch, _, pred in self.shortest_path_trees(origins):
+            for row, origin in enumerate(batch):
+                o = np.searchsorted(origins, origin)
+                for pos in by_origin[bounds[o]:bounds[o + 1]]:
+                    yield pos, self.path_edges(pred[row], origin, pairs[pos, 1])
+
+
+@dataclass
+class RouteResult:
+    origin: int
+    destination: int
+    cost: float
+    trans_ids: list
+    edges: gpd.GeoDataFrame
+    elapsed_ms: float
+
+
+class RouteQuery:
+    """
+    Point to point route queries on a compiled graph.
+
+    Single queries run A* with a straight line heuristic: the distance to the target times the
+    lowest weight per meter of any arc, which never overestimates, so routes are optimal.
+    Batch queries share one shortest path tree per origin.
+    """
+    def __init__(self, graph: CompiledGraph, edges: gpd.GeoDataFrame):
+        """
+        :param edges: Network rows in edge order, for route attributes
+        """
+        self.graph = graph
+        self.edges = edges
+        chord = np.hypot(*(graph.coords[graph.arc_u] - graph.coords[graph.arc_v]).T)
+        ratios = graph.arc_weight[chord > 0] / chord[chord > 0]
+        self.ratio = float(ratios.min()) if len(ratios) else 0.0
+        self.indptr = graph.csr.indptr.tolist()
+        self.indices = graph.csr.indices.tolist()
+        self.weights = graph.csr.data.tolist()
+        self.xs = graph.coords[:, 0].tolist()
+        self.ys = graph.coords[:, 1].tolist()
+
+    def astar(self, source, target):
+        """
+        :return: (nodes from source to target, cost) or None if there is no path
+        """
+        if self.graph.weak[source] != self.graph.weak[target]:
+            return None
+        tx, ty, ratio, xs, ys = self.xs[target], self.ys[target], self.ratio, self.xs, self.ys
+        best = {source: 0.0}
+        pred = {source: -1}
+        closed = set()
+        heap = [(math.hypot(xs[source] - tx, ys[source] - ty) * ratio, 0.0, source)]
+        while heap:
+            _, g, x = heapq.heappop(heap)
+            if x == target:
+                nodes = [x]
+                while pred[nodes[-1]] != -1:
+                    nodes.append(pred[nodes[-1]])
+                return np.asarray(nodes[::-1]), g
+            if x in closed:
+                continue
+            closed.add(x)
+            for k in range(self.indptr[x], self.indptr[x + 1]):
+                y = self.indices[k]
+                cost = g + self.weights[k]
+                if cost < best.get(y, np.inf):
+                    best[y] = cost
+                    pred[y] = x
+                    heapq.heappush(heap, (cost + math.hypot(xs[y] - tx, ys[y] - ty) * ratio, cost, y))
+        return None
+
+    def result(self, origin, destination, nodes, cost, started) -> RouteResult:
+        edges, _ = self.graph.arc_edges(self.graph.arcs(nodes[:-1], nodes[1:]))
+        rows = self.edges.iloc[edges]
+        return RouteResult(int(origin), int(destination), float(cost), list(self.graph.trans_id[edges]), rows,
+                           (time.perf_counter() - started) * 1000)
+
+    def route(self, origin, destination) -> RouteResult | None:
+        """
+        :param origin: Origin node
+        :param destination: Destination node
+        """
+        started = time.perf_counter()
+        found = self.astar(origin, destination)
+        if found is None:
+            return None
+        return self.result(origin, destination, *found, started)
+
+    def route_many(self, pairs) -> List[RouteResult | None]:
+        """
+        :param pairs: (origin node, destination node) pairs
+        :return: Result per pair, in order
+        """
+        pairs = np.asarray(list(pairs), dtype=np.int64).reshape(-1, 2)
+        results = [None] * len(pairs)
+        origins = np.unique(pairs[:, 0])
+        trees = self.graph.shortest_path_trees(origins)
+        while True:
+            # elapsed time of batch results includes the search of their chunk of origins
+            started = time.perf_counter()
+            batch, dist, pred = next(trees, (None, None, None))
+            if batch is None:
+                break
+            for row, origin in enumerate(batch):
+                for pos in np.flatnonzero(pairs[:, 0] == origin):
+                    destination = pairs[pos, 1]
+                    nodes = self.graph.path_nodes(pred[row], origin, destination)
+                    if nodes is not None:
+                        results[pos] = self.result(origin, destination, nodes, dist[row, destination], started)
+        return results
+
+
+class ContractedGraph(CompiledGraph):
+    """
+    A CompiledGraph whose arcs are chains of base arcs through pass-through nodes.
+    Nodes are the kept base nodes (node_map translates base node ids); edges, trans_id and
+    counts stay those of the base graph, so routes and counts expand back to the original segments.
+    """
+    def __init__(self, base: CompiledGraph, kept, arc_u, arc_v, arc_weight, member_ptr, member_arcs):
+        self.base = base
+        self.kept = kept
+        self.node_map = np.full(base.node_count, -1, dtype=np.int64)
+        self.node_map[kept] = np.arange(len(kept))
+        self.member_ptr = member_ptr
+        self.member_arcs = member_arcs
+        super().__init__(base.coords[kept], arc_u, arc_v, arc_weight, np.full(len(arc_u), -1),
+                         self.node_map[base.edge_u], self.node_map[base.edge_v], base.trans_id)
+
+    def summary(self) -> dict:
+        return {**super().summary(), 'base_nodes': self.base.node_count, 'base_arcs': len(self.base.arc_u)}
+
+    def routing_nodes(self, nodes) -> np.ndarray:
+        nodes = np.asarray(nodes, dtype=np.int64)
+        return np.where(nodes >= 0, self.node_map[nodes], -1)
+
+    def arc_edges(self, arcs):
+        starts = self.member_ptr[arcs]
+        lengths = self.member_ptr[np.asarray(arcs) + 1] - starts
+        owner = np.repeat(np.arange(len(arcs)), lengths)
+        offsets = np.arange(len(owner)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return self.base.arc_edge[self.member_arcs[starts[owner] + offsets]], owner
+
+
+class GraphStore:
+    """
+    Compiled graphs on disk, one directory of .npy arrays per key under the pipeline cache.
+    Arrays are memory-mapped on load.
+    """
+    # bump when the compiled layout changes
+    VERSION = 2
+    ARRAYS = ('coords', 'arc_u', 'arc_v', 'arc_weight', 'arc_edge', 'edge_u', 'edge_v', 'trans_id', 'strong', 'weak')
+
+    def __init__(self, root=None):
+        self.root = Path(root) if root else pipeline_cache_path() / 'graphs'
+
+    @classmethod
+    def key(cls, *parts) -> str:
+        """
+        :param parts: Anything the compiled graph depends on, eg content hash and compile options
+        """
+        return hashlib.sha256(json.dumps([cls.VERSION, *parts], default=str).encode('utf-8')).hexdigest()[:32]
+
+    def save(self, key, graph: CompiledGraph):
+        tmp = self.root / f'{key}.tmp-{os.getpid()}'
+        os.makedirs(tmp, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(tmp / f'{name}.npy', getattr(graph, name))
+        with open(tmp / 'graph.json', 'w') as fh:
+            json.dump({'version': self.VERSION, 'nodes': graph.node_count, 'edges': graph.edge_count,
+                       'arcs': len(graph.arc_u)}, fh)
+        try:
+            os.rename(tmp, self.root / key)
+        except OSError:
+            # saved concurrently by another run
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def load(self, key) -> CompiledGraph | None:
+        path = self.root / key
+        if not (path / 'graph.json').exists():
+            return None
+        arrays = {name: np.load(path / f'{name}.npy', mmap_mode='r') for name in self.ARRAYS}
+        return CompiledGraph(**arrays)
+
+    def load_or_compile(self, key, gdf: gpd.GeoDataFrame, **kwargs) -> CompiledGraph:
+        graph = self.load(key)
+        if graph is not None:
+            print(f'Loaded compiled graph {key}')
+            return graph
+        graph = CompiledGraph.from_gdf(gdf, **kwargs)
+        self.save(key, graph)
+        print(f'Compiled graph {key}: {graph.node_count} nodes, {graph.edge_count} edges')
+        return graph
+
+
+def od_shard(nodes, start, stop, limit=None, multiplicity=None):
+    """
+    All ordered pairs of distinct points with the origin in points[start:stop], numbered in
+    row-major order over the full point set (1-based), without building the full cross join.
+
+    :param nodes: Snapped node of each point, -1 for points that did not snap
+    :param multiplicity: Number of points each entry of nodes stands for, default 1
+    :return: (origin, destination) node pairs of the snapped pairs, their route numbers and weights
+    """
+    n = len(nodes)
+    i = np.repeat(np.arange(start, stop), n - 1)
+    k = np.tile(np.arange(n - 1), stop - start)
+    j = k + (k >= i)
+    positions = i * (n - 1) + k + 1
+    keep = (nodes[i] >= 0) & (nodes[j] >= 0)
+    if limit:
+        keep &= positions <= limit
+    i, j = i[keep], j[keep]
+    weights = None if multiplicity is None else multiplicity[i] * multiplicity[j]
+    return np.stack([nodes[i], nodes[j]], axis=1), positions[keep], weights
+
+
+# graph and point nodes inherited by forked workers
+_shared = {}
+
+
+def _accumulate_shard(shard):
+    start, stop, limit = shard
+    pairs, positions, weights = od_shard(_shared['nodes'], start, stop, limit, _shared['multiplicity'])
+    return _shared['graph'].accumulate(pairs, positions, weights)
+
+
+def accumulate_od(graph: CompiledGraph, nodes, limit=None, workers=1, shard_size=64, multiplicity=None):
+    """
+    Route counts over all ordered pairs of distinct points. Pairs are generated per shard of
+    origins, and shards run in a forked process pool that shares the compiled graph read-only;
+    partial counts are reduced as shards finish.
+
+    :param nodes: Snapped node of each point, -1 for points that did not snap
+    :param limit: Only route the first limit pairs
+    :param multiplicity: Number of points each entry of nodes stands for, default 1
+    :return: (routes through each edge, max route number through each edge, routes with no path,
+              routes skipped between components, number of pairs)
+    """
+    nodes = np.asarray(nodes, dtype=np.int64)
+    n = len(nodes)
+    iters = n * (n - 1)
+    if limit:
+        iters = min(iters, limit)
+    origins = min(n, -(-iters // (n - 1))) if n > 1 else 0
+    shards = [(s, min(s + shard_size, origins), limit) for s in range(0, origins, shard_size)]
+
+    counts = np.zeros(graph.edge_count, dtype=np.int64)
+    maxpos = np.full(graph.edge_count, -1, dtype=np.int64)
+    failed = 0
+    skipped = 0
+    _shared.update(graph=graph, nodes=nodes, multiplicity=multiplicity)
+    executor = None
+    try:
+        if workers > 1 and len(shards) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            print(f'Routing {iters} pairs in {len(shards)} shards on {workers} workers')
+            executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+            results = executor.map(_accumulate_shard, shards)
+        else:
+            results = map(_accumulate_shard, shards)
+        for c, m, f, s in results:
+            counts += c
+            np.maximum(maxpos, m, out=maxpos)
+            failed += f
+            skipped += s
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        _shared.clear()
+    return counts, maxpos, failed, skipped, iters
+
+
+def od_origin_pairs(origins, sampled, unique, multiplicity):
+    """
+    Pairs from sampled origin nodes to every other snapped node.
+
+    :param origins: Origin nodes
+    :param sampled: Number of sampled points on each origin node
+    :param unique: Snapped nodes of all points
+    :param multiplicity: Number of points on each of those nodes
+    :return: (origin, destination) node pairs and their weights (sampled origins times destination points)
+    """
+    i = np.repeat(np.arange(len(origins)), len(unique))
+    j = np.tile(np.arange(len(unique)), len(origins))
+    keep = origins[i] != unique[j]
+    i, j = i[keep], j[keep]
+    return np.stack([origins[i], unique[j]], axis=1), sampled[i] * multiplicity[j]
+
+
+def _sample_shard(shard):
+    origins, sampled, position = shard
+    pairs, weights = od_origin_pairs(origins, sampled, _shared['unique'], _shared['multiplicity'])
+    return _shared['graph'].accumulate(pairs, np.full(len(pairs), position), weights, groups=_shared['groups'])
+
+
+class OriginSampler:
+    """
+    Route counts estimated from a seeded random sample of origin points, routed batch by batch
+    to all destinations.
+
+    Each sampled point i contributes c_i(g), the routes from it through edge group g, so
+    mean c_i(g) / (n - 1) estimates the route gradient of all ordered pairs. Running sums and
+    sums of squares of c_i(g) give a normal confidence interval, with the finite population
+    correction, so the interval closes once every point is sampled. The counts of rarely used
+    edges are very skewed, so their intervals are optimistic; the stopping error is driven by
+    the busiest edges, where the normal interval holds up. Points sharing a node have
+    identical c_i, so they are routed once and the node total T counts T**2 / points to the squares.
+
+    The order of the sample only depends on the seed and the number of points, so the state
+    can be saved after each batch and a later run extends the same sample.
+    """
+    def __init__(self, graph: CompiledGraph, nodes, groups, seed=0, key=None, root=None):
+        """
+        :param nodes: Routing graph node of each point, -1 for points that did not snap
+        :param groups: Group of each edge; estimates are per group
+        :param key: If set, state is loaded from and saved to the sampling store under this key
+        """
+        self.graph = graph
+        self.nodes = np.asarray(nodes, dtype=np.int64)
+        self.groups = np.asarray(groups, dtype=np.int64)
+        self.group_count = int(self.groups.max()) + 1 if len(self.groups) else 0
+        self.order = np.random.default_rng(seed).permutation(len(self.nodes))
+        self.unique, self.multiplicity = np.unique(self.nodes[self.nodes >= 0], return_counts=True)
+        self.path = Path(root or pipeline_cache_path() / 'sampling') / f'{key}.npz' if key else None
+        self.sampled = 0
+        self.sums = np.zeros(self.group_count, dtype=np.int64)
+        self.squares = np.zeros(self.group_count, dtype=np.int64)
+        self.counts = np.zeros(graph.edge_count, dtype=np.int64)
+        self.maxpos = np.full(graph.edge_count, -1, dtype=np.int64)
+        self.failed = 0
+        self.skipped = 0
+        if self.path and self.path.exists():
+            with np.load(self.path) as state:
+                for k in ['sums', 'squares', 'counts', 'maxpos']:
+                    setattr(self, k, state[k])
+                self.sampled, self.failed, self.skipped = (int(state[k]) for k in ['sampled', 'failed', 'skipped'])
+            print(f'Resuming sample of {self.sampled} origins from {self.path}')
+
+    @property
+    def points(self):
+        return len(self.nodes)
+
+    @property
+    def pairs(self):
+        """
+        Ordered pairs with a sampled origin
+        """
+        return self.sampled * (self.points - 1)
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(self.path.parent, exist_ok=True)
+        tmp = self.path.with_suffix(f'.tmp-{os.getpid()}.npz')
+        np.savez(tmp, sums=self.sums, squares=self.squares, counts=self.counts, maxpos=self.maxpos,
+                 sampled=self.sampled, failed=self.failed, skipped=self.skipped)
+        os.replace(tmp, self.path)
+
+    def step(self, batch, workers=1, shard_size=64):
+        """
+        Routes the next batch of sampled origins. Routes through an edge are numbered with the
+        sample size after their batch.
+        """
+        take = self.nodes[self.order[self.sampled:self.sampled + batch]]
+        origins, sampled = np.unique(take[take >= 0], return_counts=True)
+        position = self.sampled + len(take)
+        shards = [(origins[s:s + shard_size], sampled[s:s + shard_size], position)
+                  for s in range(0, len(origins), shard_size)]
+        _shared.update(graph=self.graph, unique=self.unique, multiplicity=self.multiplicity, groups=self.groups)
+        executor = None
+        try:
+            if workers > 1 and len(shards) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+                executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+                results = executor.map(_sample_shard, shards)
+            else:
+                results = map(_sample_shard, shards)
+            for c, m, f, s, (origin, group, routes) in results:
+                self.counts += c
+                np.maximum(self.maxpos, m, out=self.maxpos)
+                self.failed += f
+                self.skipped += s
+                np.add.at(self.sums, group, routes)
+                np.add.at(self.squares, group, routes * routes // sampled[np.searchsorted(origins, origin)])
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            _shared.clear()
+        self.sampled += len(take)
+
+    def estimate(self, confidence=0.95):
+        """
+        :return: (estimated route gradient, confidence interval half width) per group
+        """
+        m, n = self.sampled, self.points
+        scale = 1 / (m * (n - 1)) if m and n > 1 else 0.0
+        mean = self.sums * scale
+        if m < 2:
+            return mean, np.full(self.group_count, np.inf)
+        variance = np.maximum(self.squares - self.sums.astype(float) ** 2 / m, 0) / (m - 1)
+        stderr = np.sqrt(variance / m * (1 - m / n))
+        return mean, norm.ppf((1 + confidence) / 2) * stderr / (n - 1)
+
+    def error(self, confidence=0.95):
+        """
+        :return: Largest confidence interval half width relative to the largest estimate
+        """
+        if self.sampled >= self.points:
+            return 0.0
+        mean, halfwidth = self.estimate(confidence)
+        top = mean.max() if len(mean) else 0.0
+        return float(halfwidth.max() / top) if top > 0 else np.inf
+
+    def run(self, batch=64, target_error=0.05, confidence=0.95, min_origins=None, max_origins=None, workers=1):
+        """
+        Routes batches until the error is at most target_error, every point is sampled or max_origins is reached.
+
+        :return: Whether the target error was reached
+        """
+        limit = min(self.points, max_origins or self.points)
+        min_origins = min(limit, batch if min_origins is None else min_origins)
+        while True:
+            error = self.error(confidence)
+            if self.sampled >= min_origins and error <= target_error:
+                return True
+            if self.sampled >= limit:
+                return False
+            self.step(min(batch, limit - self.sampled), workers)
+            self.save()
+            print(f'Sampled {self.sampled} of {self.points} origins, error {self.error(confidence):.4f}')
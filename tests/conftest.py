@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules are flat in the repository root, and constants reads config.toml from the working directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
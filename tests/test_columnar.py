@@ -0,0 +1,18 @@
+import geopandas as gpd
+import numpy as np
+import pyarrow.parquet as pq
+
+import columnar
+
+
+def test_series_sources_with_the_same_name_are_all_written(tmp_path):
+    sources = []
+    for i in range(2):
+        raw = tmp_path / f'raw{i}.geojson'
+        gdf = gpd.GeoDataFrame({'a': [f'{i}-{j}' for j in range(3)]},
+                               geometry=gpd.points_from_xy(np.arange(3) - 87.6, np.arange(3) + 41.8), crs=4326)
+        gdf.to_file(raw)
+        sources.append(('Permits', columnar.ensure_sidecar(raw)))
+    outdir = columnar.write_series(sources, tmp_path / 'series')
+    table = pq.read_table(outdir)
+    assert sorted(table.column('a').to_pylist()) == ['0-0', '0-1', '0-2', '1-0', '1-1', '1-2']
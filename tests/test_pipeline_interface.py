@@ -0,0 +1,29 @@
+import geopandas as gpd
+import pandas as pd
+import shapely
+
+from pipeline_interface import PipelineResult
+
+
+def round_trip(obj, tmp_path):
+    filename = PipelineResult(obj=obj).serialize(tmp_path, 'geopandas.GeoDataFrame')
+    return PipelineResult.from_cached(str(tmp_path / filename), 'geopandas.GeoDataFrame').get()
+
+
+def test_empty_geodataframe_round_trip(tmp_path):
+    result = round_trip(gpd.GeoDataFrame(), tmp_path)
+    assert isinstance(result, gpd.GeoDataFrame)
+    assert result.empty
+
+
+def test_plain_dataframe_round_trip(tmp_path):
+    df = pd.DataFrame({'a': [1, 2], 'b': ['x', 'y']})
+    result = round_trip(df, tmp_path)
+    pd.testing.assert_frame_equal(result, df)
+
+
+def test_geodataframe_round_trip(tmp_path):
+    gdf = gpd.GeoDataFrame({'a': [1]}, geometry=[shapely.Point(1, 2)], crs=26916)
+    result = round_trip(gdf, tmp_path)
+    assert result.crs == gdf.crs
+    assert result.geometry[0].equals(gdf.geometry[0])
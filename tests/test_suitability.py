@@ -0,0 +1,23 @@
+import numpy as np
+
+from map_processor import SuitabilityRules
+
+
+def test_single_multiplier_override_keeps_other_multipliers():
+    rules = SuitabilityRules({'multipliers': {'3': 2.5}})
+    expected = {**SuitabilityRules.DEFAULTS['multipliers'], '3': 2.5}
+    assert rules.rules['multipliers'] == expected
+    weights = rules.weight(np.array([10.0, 10.0, 10.0]), np.array([3, 5, 8]))
+    assert weights.tolist() == [25.0, 10.0, 5.0]
+
+
+def test_table_override_keeps_defaults_intact():
+    SuitabilityRules({'class_map': {'E': 3}, 'prohibited_weight': 5})
+    assert SuitabilityRules.DEFAULTS['class_map']['E'] == 4
+    assert SuitabilityRules.DEFAULTS['prohibited_weight'] == 1000000000
+
+
+def test_profile_multipliers_override_single_entries():
+    rules = SuitabilityRules({'multipliers': {'8': 0.4}})
+    weights = rules.weight(np.array([10.0, 10.0, 10.0]), np.array([2, 5, 8]), {'2': 0})
+    assert weights.tolist() == [1000000000.0, 10.0, 4.0]
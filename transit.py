@@ -6,9 +6,9 @@ import tempfile
 import zipfile
 import csv
 
-import requests
 from gtfs_functions import Feed
 
+import transport
 from pipeline_interface import PipelineInterface, PipelineResult
 
 
@@ -19,7 +19,7 @@ class GTFSFetcher(PipelineInterface):
     def run_stage(self) -> PipelineResult:
         rv = PipelineResult()
         url = self.stage_info['parameters']['url']
-        req = requests.get(url)
+        req = transport.get(url)
         rv.obj = req.content
         return rv
 
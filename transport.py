@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""
+Pluggable HTTP transport used by the fetchers.
+
+Modes (config.toml http_transport, overridable with GEOPIPELINE_TRANSPORT):
+- live: plain requests.get
+- record: live requests, and every response is saved to the cassette store
+- replay: responses only come from the cassette store; a missing cassette is an error
+- local: cassettes are served by a local HTTP server with simulated latency and
+  bandwidth, so the full socket and decoding path is exercised offline
+
+Record once with network access, then benchmark fetch, parse and upsert
+end to end on an offline box with replay or local.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from constants import cassette_path, configreader
+
+# requests has already decoded the body, so these no longer describe the stored content
+DROPPED_HEADERS = {'content-encoding', 'transfer-encoding', 'content-length', 'connection'}
+
+
+@dataclass
+class CassetteResponse:
+    url: str
+    status_code: int
+    headers: CaseInsensitiveDict = field(default_factory=CaseInsensitiveDict)
+    content: bytes = b''
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class CassetteStore:
+    def __init__(self, path):
+        self.path = Path(path)
+
+    @staticmethod
+    def key(url) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def save(self, url, response):
+        os.makedirs(self.path, exist_ok=True)
+        key = self.key(url)
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in DROPPED_HEADERS}
+        with open(self.path / f'{key}.body', 'wb') as fh:
+            fh.write(response.content)
+        with open(self.path / f'{key}.json', 'w') as fh:
+            json.dump({'url': url, 'status_code': response.status_code, 'headers': headers}, fh, indent=2)
+
+    def load_key(self, key) -> CassetteResponse | None:
+        meta = self.path / f'{key}.json'
+        if not meta.exists():
+            return None
+        with open(meta) as fh:
+            d = json.load(fh)
+        with open(self.path / f'{key}.body', 'rb') as fh:
+            content = fh.read()
+        return CassetteResponse(d['url'], d['status_code'], CaseInsensitiveDict(d['headers']), content)
+
+    def load(self, url) -> CassetteResponse | None:
+        return self.load_key(self.key(url))
+
+
+class Transport(ABC):
+    @abstractmethod
+    def get(self, url):
+        pass
+
+
+class LiveTransport(Transport):
+    def get(self, url):
+        return requests.get(url)
+
+
+class RecordingTransport(LiveTransport):
+    def __init__(self, store: CassetteStore):
+        self.store = store
+
+    def get(self, url):
+        response = super().get(url)
+        self.store.save(url, response)
+        return response
+
+
+class ReplayTransport(Transport):
+    def __init__(self, store: CassetteStore):
+        self.store = store
+
+    def get(self, url):
+        response = self.store.load(url)
+        if response is None:
+            raise KeyError(f'No cassette recorded for {url}')
+        return response
+
+
+class CassetteServer(ThreadingHTTPServer):
+    """
+    Serves recorded cassettes at /<cassette key>, waiting latency seconds before the
+    response and throttling the body to bandwidth bytes per second if set.
+    """
+    daemon_threads = True
+
+    def __init__(self, store: CassetteStore, latency=0.0, bandwidth=None, port=0):
+        self.store = store
+        self.latency = latency
+        self.bandwidth = bandwidth
+        super().__init__(('127.0.0.1', port), CassetteHandler)
+
+
+class CassetteHandler(BaseHTTPRequestHandler):
+    CHUNK = 65536
+
+    def do_GET(self):
+        server: CassetteServer = self.server
+        time.sleep(server.latency)
+        response = server.store.load_key(self.path.strip('/'))
+        if response is None:
+            self.send_error(404)
+            return
+        self.send_response(response.status_code)
+        for k, v in response.headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(response.content)))
+        self.end_headers()
+        for i in range(0, len(response.content), self.CHUNK):
+            chunk = response.content[i:i + self.CHUNK]
+            self.wfile.write(chunk)
+            if server.bandwidth:
+                time.sleep(len(chunk) / server.bandwidth)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServerTransport(Transport):
+    def __init__(self, store: CassetteStore, latency=0.0, bandwidth=None):
+        self.server = CassetteServer(store, latency, bandwidth)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def get(self, url):
+        host, port = self.server.server_address
+        return requests.get(f'http://{host}:{port}/{CassetteStore.key(url)}')
+
+
+_transport: Transport | None = None
+_transport_lock = threading.Lock()
+
+
+def make_transport(mode=None) -> Transport:
+    mode = mode or os.environ.get('GEOPIPELINE_TRANSPORT') or configreader.http_transport
+    store = CassetteStore(cassette_path())
+    if mode == 'live':
+        return LiveTransport()
+    if mode == 'record':
+        return RecordingTransport(store)
+    if mode == 'replay':
+        return ReplayTransport(store)
+    if mode == 'local':
+        latency = float(os.environ.get('GEOPIPELINE_LATENCY', configreader.simulated_latency))
+        return LocalServerTransport(store, latency, configreader.simulated_bandwidth)
+    raise ValueError(f'Unknown transport mode {mode}')
+
+
+def get_transport() -> Transport:
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = make_transport()
+        return _transport
+
+
+def set_transport(transport: Transport):
+    global _transport
+    with _transport_lock:
+        _transport = transport
+
+
+def get(url):
+    return get_transport().get(url)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog='Transport',
+        description='Serve recorded HTTP cassettes with simulated latency',
+    )
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=configreader.simulated_latency)
+    parser.add_argument('--bandwidth', type=int, default=configreader.simulated_bandwidth)
+    args = parser.parse_args()
+    server = CassetteServer(CassetteStore(cassette_path()), args.latency, args.bandwidth, args.port)
+    print(f'Serving cassettes from {cassette_path()} on port {args.port}')
+    server.serve_forever()